@@ -1,22 +1,100 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import importlib.util
 import logging
+import multiprocessing
 import os
-import string
+import re
+import shutil
+import sqlite3
 import subprocess
+import sys
+import time
+from threading import Condition, Event, Lock, Thread
 
 import pwnagotchi.plugins as plugins
 
-# Aircrack-ng needed, to install:
+# the capture parser is shared with the other plugins in this folder
+_WPATOOLS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'wpatools')
+if 'wpatools' not in sys.modules:
+    # loaded by path: with this folder on sys.path "import telegram" would find telegram.py
+    _spec = importlib.util.spec_from_file_location('wpatools', os.path.join(_WPATOOLS, '__init__.py'),
+                                                   submodule_search_locations=[_WPATOOLS])
+    sys.modules['wpatools'] = importlib.util.module_from_spec(_spec)
+    _spec.loader.exec_module(sys.modules['wpatools'])
+from wpatools.analysis import ANALYSIS_DB, PcapAnalysis, shared  # noqa: E402
+from wpatools import pool as forkpool  # noqa: E402
+
+# The python backend needs nothing else. For backend: aircrack-ng, install it with:
 # > apt-get install aircrack-ng
 
+AIRCRACK_HANDSHAKES = re.compile(rb'\((\d+) handshake')
+
+# files other plugins keep next to a pcap, quarantined along with it
+SIDECARS = ('.gps.json', '.geo.json', '.paw-gps.json', '.2500', '.16800', '.22000')
+
+
+def classify(filename, backend='python', analysis=None):
+    """Return 'handshake', 'pmkid' or None for a capture, reading it at most once per version."""
+    if backend == 'aircrack-ng':
+        # without a wordlist aircrack-ng only lists the networks, which is all we need
+        result = subprocess.run(['aircrack-ng', filename], stdin=subprocess.DEVNULL,
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        if any(int(count) > 0 for count in AIRCRACK_HANDSHAKES.findall(result.stdout)):
+            return 'handshake'
+        if b'PMKID' in result.stdout:
+            return 'pmkid'
+        return None
+    return (analysis or PcapAnalysis(keep=0)).crackable(filename)
+
+
+class VerdictIndex:
+    """SQLite record of the verdict for every pcap, keyed on its path, size and mtime,
+    so a sweep only looks at pcaps that are new or changed since the last one."""
+
+    def __init__(self, path):
+        self.lock = Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS verdicts (path TEXT PRIMARY KEY, size INTEGER, mtime REAL, '
+                        'verdict TEXT, checked REAL)')
+        self.db.commit()
+
+    def lookup(self, path, st):
+        """Return the verdict ('handshake', 'pmkid' or '') of this version of the pcap, or None."""
+        with self.lock:
+            row = self.db.execute('SELECT verdict FROM verdicts WHERE path = ? AND size = ? AND mtime = ?',
+                                  (path, st.st_size, st.st_mtime)).fetchone()
+        return row[0] if row else None
+
+    def record(self, path, st, verdict):
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO verdicts VALUES (?, ?, ?, ?, ?)',
+                            (path, st.st_size, st.st_mtime, verdict or '', time.time()))
+            self.db.commit()
+
+    def forget(self, path):
+        with self.lock:
+            self.db.execute('DELETE FROM verdicts WHERE path = ?', (path,))
+            self.db.commit()
+
 
 class AircrackOnly(plugins.Plugin):
     __author__ = 'pwnagotchi [at] rossmarks [dot] uk'
-    __version__ = '1.0.1'
+    __version__ = '1.2.0'
     __license__ = 'GPL3'
-    __description__ = 'confirm pcap contains handshake/PMKID or delete it'
+    __description__ = 'confirm pcap contains handshake/PMKID or quarantine it'
 
     def __init__(self):
         self.text_to_set = ""
+        self.backend = 'python'
+        self.quiet = 10
+        self.quarantine = ''
+        self.index = None
+        self.analysis = PcapAnalysis()
+        self._agent = None
+        self._pending = {}
+        self._queued = Condition()
+        self._stop = Event()
 
     def on_loaded(self):
         logging.info("[aircrackonly] Plugin loaded.")
@@ -24,40 +102,186 @@ class AircrackOnly(plugins.Plugin):
         if 'face' not in self.options:
             self.options['face'] = '(>.<)'
 
-        check = subprocess.run(
-            ("/usr/bin/dpkg -l aircrack-ng | grep aircrack-ng | awk '{ print $2, $3; }'"), shell=True, stdout=subprocess.PIPE)
-        check = check.stdout.decode('utf-8').strip()
-        if check != "aircrack-ng <none>":
-            logging.info(f"[aircrackonly] Found {check}.")
-        else:
-            logging.warning("[aircrackonly] aircrack-ng is not installed!")
+        self.backend = self.options.get('backend', 'python')
+        if self.backend == 'aircrack-ng':
+            if shutil.which('aircrack-ng'):
+                logging.info(f"[aircrackonly] Using {shutil.which('aircrack-ng')}.")
+            else:
+                logging.warning("[aircrackonly] aircrack-ng is not installed, falling back to the python backend!")
+                self.backend = 'python'
+        self.quiet = self.options.get('quiet', 10)
+        self.quarantine = self.options.get('quarantine', '/root/quarantine')
+        self.analysis = shared(self.options.get('analysis', ANALYSIS_DB))
+        try:
+            self.index = VerdictIndex(self.options.get('index', '/root/.aircrackonly.db'))
+        except sqlite3.Error as e:
+            logging.warning(f"[aircrackonly] Could not open the verdict index, every pcap will be checked again: {e}")
+        Thread(target=self._verifyWorker, name='aircrackonly-verify', daemon=True).start()
+
+    # called when everything is ready and the main loop is about to start
+    def on_config_changed(self, config):
+        if self.options.get('sweep', False):
+            Thread(target=self._sweep, args=(config['bettercap']['handshakes'],),
+                   name='aircrackonly-sweep', daemon=True).start()
+
+    def on_unload(self, ui):
+        self._stop.set()
+        with self._queued:
+            self._queued.notify()
+
+    def _classify(self, filename):
+        return classify(filename, self.backend, self.analysis)
+
+    def _sweepWorkerSetup(self):
+        # sweep workers are forked, they get their own in-memory analysis instead of the shared sqlite one
+        self.index = None
+        self.analysis = PcapAnalysis(keep=0)
+
+    def _sweepOne(self, filename):
+        # runs in a sweep worker
+        return filename, self._classify(filename)
 
     def on_handshake(self, agent, filename, access_point, client_station):
-        display = agent._view
-        todelete = 0
-        handshakeFound = 0
-
-        result = subprocess.run((f"/usr/bin/aircrack-ng {filename} | grep '1 handshake' | awk '{{ print $2; }}'"),
-                                shell=True, stdout=subprocess.PIPE)
-        result = result.stdout.decode('utf-8').translate({ord(c): None for c in string.whitespace})
-        if result:
-            handshakeFound = 1
-            logging.info("[aircrackonly] {filename} contains handshake.")
-
-        if handshakeFound == 0:
-            result = subprocess.run(('/usr/bin/aircrack-ng ' + filename + ' | grep "PMKID" | awk \'{print $2}\''),
-                                    shell=True, stdout=subprocess.PIPE)
-            result = result.stdout.decode('utf-8').translate({ord(c): None for c in string.whitespace})
-            if result:
-                logging.info("[aircrackonly] {filename} contains PMKID.")
-            else:
-                todelete = 1
+        # bettercap reports the same pcap several times while it is still appending to it,
+        # so only queue it here and let the worker look at it once it has gone quiet
+        self._agent = agent
+        with self._queued:
+            self._pending[filename] = time.monotonic()
+            self._queued.notify()
+
+    def _verifyWorker(self):
+        while not self._stop.is_set():
+            with self._queued:
+                now = time.monotonic()
+                due = {filename: last + self.quiet for filename, last in self._pending.items()}
+                ready = [filename for filename, when in due.items() if when <= now]
+                if not ready:
+                    self._queued.wait(timeout=min(due.values()) - now if due else None)
+                    continue
+                for filename in ready:
+                    del self._pending[filename]
+            removed = 0
+            for filename in ready:
+                try:
+                    removed += self._verify(filename)
+                except Exception as e:
+                    logging.error(f"[aircrackonly] Could not verify {filename}: {e}")
+            if removed and self._agent:
+                self.text_to_set = f"Removed {removed} uncrackable pcap{'s' if removed > 1 else ''}"
+                self._agent._view.update(force=True)
+
+    def _verify(self, filename):
+        """Check a quiet pcap once per version, return 1 if it was removed."""
+        try:
+            st = os.stat(filename)
+        except FileNotFoundError:
+            return 0
+        if time.time() - st.st_mtime < self.quiet:
+            # still being written to, look again later
+            with self._queued:
+                self._pending.setdefault(filename, time.monotonic())
+            return 0
+        if self.index and self.index.lookup(filename, st) is not None:
+            return 0
+
+        verdict = self._classify(filename)
+        if verdict == 'handshake':
+            logging.info(f"[aircrackonly] {filename} contains handshake.")
+        elif verdict == 'pmkid':
+            logging.info(f"[aircrackonly] {filename} contains PMKID.")
+        else:
+            self._discard(filename)
+            return 1
+        if self.index:
+            self.index.record(filename, st, verdict)
+        return 0
 
-        if todelete == 1:
-            os.remove(filename)
-            self.text_to_set = "Removed an uncrackable pcap"
+    def _discard(self, filename):
+        """Move an uncrackable pcap and its sidecars into the quarantine folder, or remove them if there is none."""
+        stem = filename[:-len('.pcap')] if filename.endswith('.pcap') else filename
+        files = [filename] + [stem + ext for ext in SIDECARS if os.path.isfile(stem + ext)]
+        for path in files:
+            if self.quarantine:
+                os.makedirs(self.quarantine, exist_ok=True)
+                shutil.move(path, os.path.join(self.quarantine, os.path.basename(path)))
+            else:
+                os.remove(path)
+        if self.index:
+            self.index.forget(filename)
+        if self.quarantine:
+            logging.warning(f"[aircrackonly] Quarantined uncrackable pcap {filename}")
+        else:
             logging.warning(f"Removed uncrackable pcap {filename}")
-            display.update(force=True)
+
+    def _sweep(self, handshake_dir):
+        """Check every pcap already in the handshake folder, a few at a time in worker processes.
+        With sweep_dry_run only report what would be quarantined and how much space that frees."""
+        dry_run = self.options.get('sweep_dry_run', True)
+        workers = max(1, self.options.get('sweep_workers', 2))
+        with os.scandir(handshake_dir) as entries:
+            pcaps = [entry.path for entry in entries if entry.name.endswith('.pcap')]
+        logging.info(f"[aircrackonly] Sweeping {len(pcaps)} pcaps in {handshake_dir}{' (dry run)' if dry_run else ''}...")
+        checked = cached = 0
+        uncrackable = []
+        pending = deque()
+        forkpool.bind(self)
+        pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork'),
+                                   initializer=forkpool.init,
+                                   initargs=(self.options.get('nice', 10), None, '_sweepWorkerSetup'))
+
+        def collect(filename, st, future):
+            nonlocal checked
+            try:
+                filename, verdict = future.result()
+            except Exception as e:
+                # one pcap the worker choked on is no reason to give up on the others
+                logging.error(f"[aircrackonly] Sweep: could not check {filename}: {e!r}")
+                return
+            checked += 1
+            if self.index:
+                self.index.record(filename, st, verdict)
+            if verdict is None:
+                uncrackable.append((filename, st.st_size))
+
+        try:
+            for filename in pcaps:
+                if self._stop.is_set():
+                    break
+                try:
+                    st = os.stat(filename)
+                except OSError:
+                    continue
+                if filename in self._pending or time.time() - st.st_mtime < self.quiet:
+                    continue  # the live queue takes care of it
+                verdict = self.index.lookup(filename, st) if self.index else None
+                if verdict is not None:
+                    cached += 1
+                    if not verdict:
+                        uncrackable.append((filename, st.st_size))
+                    continue
+                pending.append((filename, st, pool.submit(forkpool.call, '_sweepOne', filename)))
+                if len(pending) >= workers * 2:
+                    collect(*pending.popleft())
+            while pending:
+                collect(*pending.popleft())
+        finally:
+            pool.shutdown(wait=False)
+
+        reclaimed = sum(size for filename, size in uncrackable)
+        # a sweep never deletes, without a quarantine folder it can only report
+        if dry_run or not self.quarantine:
+            for filename, size in uncrackable:
+                logging.info(f"[aircrackonly] Sweep: would quarantine {filename} ({size // 1024}KB)")
+            logging.info(f"[aircrackonly] Sweep (dry run): {checked} pcaps checked, {cached} known from the index, "
+                         f"{len(uncrackable)} uncrackable, {reclaimed // 1024}KB would be reclaimed.")
+            return
+        for filename, size in uncrackable:
+            try:
+                self._discard(filename)
+            except OSError as e:
+                logging.error(f"[aircrackonly] Could not quarantine {filename}: {e}")
+        logging.info(f"[aircrackonly] Sweep: {checked} pcaps checked, {cached} known from the index, "
+                     f"{len(uncrackable)} uncrackable, {reclaimed // 1024}KB reclaimed.")
 
     def on_ui_update(self, ui):
         if self.text_to_set:
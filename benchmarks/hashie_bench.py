@@ -0,0 +1,174 @@
+"""
+Benchmark hashie against a synthetic corpus and write the results as JSON.
+
+    python3 benchmarks/hashie_bench.py --pcaps 500 --output hashie-bench.json
+
+Runs the batch conversion twice (cold, then with a warm index) and feeds every
+pcap through on_handshake, reporting pcaps/second, peak RSS and the number of
+subprocesses and pool workers started. Every phase runs in a forked child with a
+fresh plugin (like after a reboot, the index and analysis on disk carry over),
+so the RSS and process counts are that phase's own. Needs the pwnagotchi package to be importable, so run it
+on the unit or a host with pwnagotchi installed. Everything is written to a
+temporary folder, nothing under /root is touched.
+"""
+import argparse
+import glob
+import json
+import multiprocessing
+import multiprocessing.process
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import pcapgen  # noqa: E402
+import hashie  # noqa: E402
+
+spawned = 0
+pool_workers = 0
+_popen_init = subprocess.Popen.__init__
+_process_start = multiprocessing.process.BaseProcess.start
+
+
+def _counting_popen_init(self, *args, **kwargs):
+    global spawned
+    spawned += 1
+    _popen_init(self, *args, **kwargs)
+
+
+def _counting_process_start(self):
+    # ProcessPoolExecutor workers and any other multiprocessing children
+    global pool_workers
+    pool_workers += 1
+    _process_start(self)
+
+
+subprocess.Popen.__init__ = _counting_popen_init
+multiprocessing.process.BaseProcess.start = _counting_process_start
+
+
+def rss_mb():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+
+
+def peak_rss_mb(start):
+    # ru_maxrss is in kilobytes on linux, a forked child starts at the RSS of its parent
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    return {'self': round(own, 1), 'growth': round(own - start, 1), 'children': round(children, 1)}
+
+
+def make_plugin(work, args, name):
+    plugin = hashie.hashie()
+    plugin.options = {
+        'backend': args.backend,
+        'workers': args.workers,
+        'index': os.path.join(work, f'{name}.db'),
+        'analysis': os.path.join(work, f'{name}-analysis.db'),
+        'incomplete': os.path.join(work, f'{name}.incompletePcaps'),
+        'debounce': 0,
+    }
+    plugin.on_loaded()
+    return plugin
+
+
+def remove_hashes(folder):
+    for ext in ('2500', '16800', '22000'):
+        for path in glob.glob(os.path.join(folder, f'*.{ext}')):
+            os.remove(path)
+
+
+def timed(label, count, func):
+    """Run func in a forked child and return its timing, peak RSS and process counts."""
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+
+    def phase():
+        global spawned, pool_workers
+        spawned = pool_workers = 0
+        base = rss_mb()
+        start = time.monotonic()
+        func()
+        seconds = time.monotonic() - start
+        sender.send({'seconds': round(seconds, 3), 'pcaps_per_second': round(count / seconds, 1) if seconds else None,
+                     'subprocesses': spawned, 'pool_workers': pool_workers, 'peak_rss_mb': peak_rss_mb(base)})
+
+    child = multiprocessing.get_context('fork').Process(target=phase)
+    _process_start(child)
+    result = receiver.recv()
+    child.join()
+    print(f'{label}: {count} pcaps in {result["seconds"]:.2f}s ({result["pcaps_per_second"]}/s), '
+          f'{result["subprocesses"]} subprocesses, {result["pool_workers"]} pool workers, '
+          f'+{result["peak_rss_mb"]["growth"]}MB RSS', file=sys.stderr)
+    return result
+
+
+def drain(plugin):
+    while plugin._pending or plugin._live:
+        time.sleep(0.01)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--pcaps', type=int, default=200, help='corpus size')
+    parser.add_argument('--lonely', type=float, default=0.3, help='share of captures without a usable hash')
+    parser.add_argument('--corrupt', type=float, default=0.05, help='share of truncated or garbled captures')
+    parser.add_argument('--noise', type=int, default=50, help='encrypted data frames per capture')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--backend', default='python', choices=('python', 'hcxpcaptool'))
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--output', help='write the JSON results here instead of stdout')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='hashie-bench-') as work:
+        handshakes = os.path.join(work, 'handshakes')
+        start = time.monotonic()
+        captures = pcapgen.corpus(handshakes, args.pcaps, args.lonely, args.corrupt, args.noise, args.seed)
+        kinds = {kind: sum(1 for capture in captures if capture[1] == kind) for kind in ('handshake', 'lonely', 'corrupt')}
+        corpus_bytes = sum(os.path.getsize(capture[0]) for capture in captures)
+        print(f'corpus: {kinds} ({corpus_bytes // 1024}KB) in {time.monotonic() - start:.2f}s', file=sys.stderr)
+
+        def batch_all():
+            make_plugin(work, args, 'batch')._process_stale_pcaps(handshakes)
+        results = {'batch_cold': timed('batch (cold)', len(captures), batch_all)}
+        converted = len(glob.glob(os.path.join(handshakes, '*.2500')) + glob.glob(os.path.join(handshakes, '*.16800')))
+        results['batch_warm'] = timed('batch (warm index)', len(captures), batch_all)
+
+        remove_hashes(handshakes)
+
+        def handshake_all():
+            live = make_plugin(work, args, 'live')
+            for path, kind, essid, passphrase in captures:
+                bssid = path[:-5].split('_')[-1]
+                live.on_handshake(None, path, {'mac': ':'.join(bssid[i:i + 2] for i in range(0, 12, 2)),
+                                               'hostname': essid.decode()}, None)
+            drain(live)
+        results['on_handshake'] = timed('on_handshake', len(captures), handshake_all)
+
+    report = {
+        'benchmark': 'hashie',
+        'version': hashie.hashie.__version__,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'options': vars(args),
+        'corpus': {'pcaps': len(captures), 'bytes': corpus_bytes, **kinds},
+        'hash_files': converted,
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+"""
+Synthetic capture generator for the benchmarks, no radio needed.
+
+Writes radiotap pcaps the way bettercap does: a beacon, some encrypted data
+traffic and the 4-way handshake with a valid MIC (plus a PMKID in M1) for a
+known passphrase, so the hashes it produces can actually be cracked. Corpora
+mix in lonely captures (beacons and traffic only) and corrupt files.
+"""
+import hashlib
+import hmac
+import os
+import random
+import struct
+
+LLC_EAPOL = b'\xaa\xaa\x03\x00\x00\x00\x88\x8e'
+RADIOTAP_PRESENT = 0x0000082e  # flags, rate, channel, antenna signal, rx flags
+RSN_IE = b'\x30\x14\x01\x00\x00\x0f\xac\x04\x01\x00\x00\x0f\xac\x04\x01\x00\x00\x0f\xac\x02\x00\x00'
+
+
+def random_bytes(rng, length):
+    return rng.getrandbits(8 * length).to_bytes(length, 'little')
+
+
+def radiotap(channel=6, signal=-50):
+    freq = 2407 + channel * 5 if channel < 14 else 2484
+    return struct.pack('<BBHIBBHHbxH', 0, 0, 18, RADIOTAP_PRESENT, 0, 2, freq, 0x00a0, signal, 0)
+
+
+def beacon(bssid, essid, subtype=8, seq=0):
+    header = struct.pack('<BBH', subtype << 4, 0, 0) + b'\xff' * 6 + bssid + bssid + struct.pack('<H', seq << 4)
+    fixed = bytes(8) + struct.pack('<HH', 100, 0x0431)
+    return header + fixed + bytes([0, len(essid)]) + essid + b'\x01\x08\x82\x84\x8b\x96\x0c\x12\x18\x24' + RSN_IE
+
+
+def data(src, dst, bssid, from_ds, payload, protected=False, qos=True):
+    flags = (2 if from_ds else 1) | (0x40 if protected else 0)
+    addrs = dst + bssid + src if from_ds else bssid + src + dst
+    header = struct.pack('<BBH', 0x88 if qos else 0x08, flags, 0x013a) + addrs + b'\x00\x00'
+    if qos:
+        header += b'\x00\x00'
+    return header + payload
+
+
+def eapol_key(key_info, replay, nonce, mic=bytes(16), key_data=b''):
+    body = (struct.pack('>BHHQ', 2, key_info, 16, replay) + nonce + bytes(16) + bytes(8) + bytes(8) + mic
+            + struct.pack('>H', len(key_data)) + key_data)
+    return struct.pack('>BBH', 2, 3, len(body)) + body
+
+
+def prf512(pmk, label, data):
+    return b''.join(hmac.new(pmk, label + b'\x00' + data + bytes([i]), hashlib.sha1).digest() for i in range(4))[:64]
+
+
+def handshake(passphrase, essid, ap, sta, rng, pmkid=True, messages=(1, 2, 3, 4)):
+    """Return the data frames of a WPA2 (key version 2) 4-way handshake with correct MICs."""
+    pmk = hashlib.pbkdf2_hmac('sha1', passphrase, essid, 4096, 32)
+    anonce = random_bytes(rng, 32)
+    snonce = random_bytes(rng, 32)
+    ptk = prf512(pmk, b'Pairwise key expansion',
+                 min(ap, sta) + max(ap, sta) + min(anonce, snonce) + max(anonce, snonce))
+
+    def signed(key_info, replay, nonce, key_data=b''):
+        frame = eapol_key(key_info, replay, nonce, key_data=key_data)
+        mic = hmac.new(ptk[:16], frame, hashlib.sha1).digest()[:16]
+        return frame[:81] + mic + frame[97:]
+
+    key_data = b''
+    if pmkid:
+        key_data = b'\xdd\x14\x00\x0f\xac\x04' + hmac.new(pmk, b'PMK Name' + ap + sta, hashlib.sha1).digest()[:16]
+    frames = {
+        1: data(ap, sta, ap, True, LLC_EAPOL + eapol_key(0x008a, 1, anonce, key_data=key_data)),
+        2: data(sta, ap, ap, False, LLC_EAPOL + signed(0x010a, 1, snonce, RSN_IE)),
+        3: data(ap, sta, ap, True, LLC_EAPOL + signed(0x13ca, 2, anonce, bytes(56))),
+        4: data(sta, ap, ap, False, LLC_EAPOL + signed(0x030a, 2, bytes(32))),
+    }
+    return [frames[msg] for msg in messages]
+
+
+def write_pcap(path, frames, start=1600000000):
+    with open(path, 'wb') as f:
+        f.write(struct.pack('<IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, 65535, 127))
+        for num, frame in enumerate(frames):
+            record = radiotap() + frame
+            f.write(struct.pack('<IIII', start + num // 100, (num % 100) * 10000, len(record), len(record)))
+            f.write(record)
+
+
+def corpus(folder, count, lonely=0.3, corrupt=0.05, noise=50, seed=1):
+    """Write count pcaps into folder, named like bettercap does (essid_bssid.pcap).
+    Returns a list of (path, kind, essid, passphrase) with kind one of handshake, lonely or corrupt."""
+    rng = random.Random(seed)
+    os.makedirs(folder, exist_ok=True)
+    captures = []
+    for num in range(count):
+        ap = b'\x02' + random_bytes(rng, 5)
+        sta = b'\x06' + random_bytes(rng, 5)
+        essid = f'bench-{num}'.encode()
+        passphrase = f'password{num:04d}'.encode()
+        path = os.path.join(folder, f'{essid.decode()}_{ap.hex()}.pcap')
+        frames = [beacon(ap, essid, seq=i) for i in range(rng.randint(1, 10))]
+        frames += [data(sta, ap, ap, bool(i % 2), random_bytes(rng, rng.randint(60, 1400)), protected=True)
+                   for i in range(noise)]
+        roll = rng.random()
+        if roll < corrupt:
+            kind = 'corrupt'
+        elif roll < corrupt + lonely:
+            kind = 'lonely'
+            frames += handshake(passphrase, essid, ap, sta, rng, pmkid=False, messages=(rng.choice((1, 2, 3, 4)),))
+        else:
+            kind = 'handshake'
+            frames += handshake(passphrase, essid, ap, sta, rng, pmkid=rng.random() < 0.5)
+        write_pcap(path, frames)
+        if kind == 'corrupt':
+            with open(path, 'r+b') as f:
+                size = os.fstat(f.fileno()).st_size
+                if rng.random() < 0.5:
+                    f.truncate(rng.randint(0, size - 1))  # cut mid-record, or before the header ends
+                else:
+                    f.seek(rng.randint(0, size - 4))
+                    f.write(random_bytes(rng, 4))
+        captures.append((path, kind, essid, passphrase))
+    return captures
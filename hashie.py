@@ -1,18 +1,171 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
+import hashlib
+import importlib.util
 import json
 import logging
+import math
+import multiprocessing
 import os
+import shutil
+import sqlite3
+import struct
 import subprocess
-from threading import Lock
+import sys
+import time
+from threading import Condition, Event, Lock, Thread
 
 import pwnagotchi.plugins as plugins
 from pwnagotchi.ui.components import LabeledValue
 from pwnagotchi.ui.view import BLACK
 import pwnagotchi.ui.fonts as fonts
 
+# the capture parser is shared with the other plugins in this folder
+_WPATOOLS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'wpatools')
+if 'wpatools' not in sys.modules:
+    # loaded by path: with this folder on sys.path "import telegram" would find telegram.py
+    _spec = importlib.util.spec_from_file_location('wpatools', os.path.join(_WPATOOLS, '__init__.py'),
+                                                   submodule_search_locations=[_WPATOOLS])
+    sys.modules['wpatools'] = importlib.util.module_from_spec(_spec)
+    _spec.loader.exec_module(sys.modules['wpatools'])
+from wpatools.analysis import ANALYSIS_DB, PcapAnalysis, shared  # noqa: E402
+from wpatools.pcap import PARSER_VERSION, CaptureInfo, PcapError, compact_pcap  # noqa: E402
+from wpatools import pool as forkpool  # noqa: E402
+
+
+# sidecars other plugins leave next to a pcap, in order of preference, and how to read them
+LOCATION_SIDECARS = (
+    ('gps.json', lambda data: (data['Latitude'], data['Longitude'], 50)),
+    ('geo.json', lambda data: (data['location']['lat'], data['location']['lng'], data['accuracy'])),
+    ('paw-gps.json', lambda data: (data['lat'], data['long'], 50)),
+)
+
+
+def cluster_locations(locations, meters):
+    """Group (name, lat, lng, accuracy) points on a grid of roughly meters wide cells and
+    return (names, lat, lng, accuracy) per cell, positioned at the cell's centroid."""
+    cells = {}
+    for name, lat, lng, accuracy in locations:
+        lat_step = meters / 111320
+        lng_step = meters / (111320 * max(math.cos(math.radians(lat)), 0.01))
+        cells.setdefault((round(lat / lat_step), round(lng / lng_step)), []).append((name, lat, lng, accuracy))
+    for points in cells.values():
+        yield ([point[0] for point in points], sum(point[1] for point in points) / len(points),
+               sum(point[2] for point in points) / len(points), max(point[3] for point in points))
+
+
+class ConversionIndex:
+    """SQLite record of every conversion attempt, keyed on the pcap's path, size and mtime.
+
+    A pcap is only converted again once its content or the converter changes, so
+    pcaps that can never yield a hash are not retried on every boot. The same
+    database keeps every BSSID -> ESSID pair hashie has seen, across all captures."""
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS pcaps (path TEXT PRIMARY KEY, size INTEGER, mtime REAL, '
+                        'converter TEXT, eapol INTEGER, pmkid INTEGER, checked REAL, wanted TEXT, compacted INTEGER)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS essids (bssid BLOB PRIMARY KEY, essid BLOB, seen REAL)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS locations (pcap TEXT PRIMARY KEY, sidecar TEXT, mtime REAL, '
+                        'lat REAL, lng REAL, accuracy REAL)')
+        columns = [row[1] for row in self.db.execute('PRAGMA table_info(pcaps)')]
+        for column, kind in (('wanted', 'TEXT'), ('compacted', 'INTEGER')):
+            if column not in columns:
+                self.db.execute(f'ALTER TABLE pcaps ADD COLUMN {column} {kind}')
+        self.db.commit()
+
+    def lookup(self, path, st, converter, essids=None):
+        """Return (eapol, pmkid) from the last attempt, or None if the pcap or converter changed since,
+        or if an ESSID it was missing has been seen since."""
+        row = self.db.execute('SELECT eapol, pmkid, wanted FROM pcaps WHERE path = ? AND size = ? AND mtime = ? AND converter = ?',
+                              (path, st.st_size, st.st_mtime, converter)).fetchone()
+        if not row:
+            return None
+        if row[2] and essids and any(bytes.fromhex(bssid) in essids for bssid in row[2].split(',')):
+            return None
+        return bool(row[0]), bool(row[1])
+
+    def record(self, path, st, converter, eapol, pmkid, wanted=()):
+        # whether it was compacted only holds while the pcap stays the same
+        self.db.execute('INSERT INTO pcaps VALUES (?, ?, ?, ?, ?, ?, ?, ?, NULL) ON CONFLICT(path) DO UPDATE SET '
+                        'converter = excluded.converter, eapol = excluded.eapol, pmkid = excluded.pmkid, '
+                        'checked = excluded.checked, wanted = excluded.wanted, compacted = CASE WHEN '
+                        'size = excluded.size AND mtime = excluded.mtime THEN compacted END, '
+                        'size = excluded.size, mtime = excluded.mtime',
+                        (path, st.st_size, st.st_mtime, converter, int(eapol), int(pmkid), time.time(),
+                         ','.join(bssid.hex() for bssid in wanted)))
+
+    def compacted(self, path, st):
+        """Whether the pcap went through compact_pcap since it last changed."""
+        return self.db.execute('SELECT 1 FROM pcaps WHERE path = ? AND size = ? AND mtime = ? AND compacted = 1',
+                               (path, st.st_size, st.st_mtime)).fetchone() is not None
+
+    def mark_compacted(self, path, st):
+        self.db.execute('UPDATE pcaps SET compacted = 1 WHERE path = ? AND size = ? AND mtime = ?',
+                        (path, st.st_size, st.st_mtime))
+
+    def essids(self):
+        return {bytes(bssid): bytes(essid) for bssid, essid in self.db.execute('SELECT bssid, essid FROM essids')}
+
+    def learn_essids(self, essids):
+        now = time.time()
+        self.db.executemany('INSERT OR REPLACE INTO essids VALUES (?, ?, ?)',
+                            [(bssid, essid, now) for bssid, essid in essids.items()])
+
+    def locations(self):
+        return {row[0]: row[1:] for row in self.db.execute('SELECT * FROM locations')}
+
+    def save_location(self, pcap, sidecar, mtime, lat, lng, accuracy):
+        self.db.execute('INSERT OR REPLACE INTO locations VALUES (?, ?, ?, ?, ?, ?)', (pcap, sidecar, mtime, lat, lng, accuracy))
+
+    def prune(self, paths):
+        """Forget pcaps that are no longer on disk."""
+        gone = [(path,) for path in {row[0] for row in self.db.execute('SELECT path FROM pcaps')} - set(paths)]
+        self.db.executemany('DELETE FROM pcaps WHERE path = ?', gone)
+        self.db.executemany('DELETE FROM locations WHERE pcap = ?', gone)
+
+    def commit(self):
+        self.db.commit()
+
+
+class HashStore:
+    """Append-only file with every hash hashie has extracted, deduplicated by (BSSID, client, hash).
+
+    With store_format 22000 everything goes into one hashcat 22000 file, with legacy the
+    EAPOL records are appended to <store>.2500 (hccapx) and the PMKIDs to <store>.16800."""
+
+    def __init__(self, db, path, store_format):
+        self.db = db
+        self.path = path
+        self.format = store_format
+        self.db.execute('CREATE TABLE IF NOT EXISTS hashes (store TEXT, bssid BLOB, sta BLOB, hash BLOB, pcap TEXT, '
+                        'added REAL, PRIMARY KEY (store, bssid, sta, hash))')
+        self.db.commit()
+
+    def add(self, pcap, entries):
+        """Append the entries not stored yet, returns how many were new."""
+        now = time.time()
+        new = {}
+        for bssid, sta, key, line, ext, record in entries:
+            target = self.path if self.format == '22000' else f'{self.path}.{ext}'
+            if self.db.execute('INSERT OR IGNORE INTO hashes VALUES (?, ?, ?, ?, ?, ?)',
+                               (target, bssid, sta, key, pcap, now)).rowcount:
+                new.setdefault(target, []).append(f'{line}\n'.encode() if self.format == '22000' else record)
+        try:
+            for target, chunks in new.items():
+                with open(target, 'ab') as store:
+                    store.write(b''.join(chunks))
+        except OSError:
+            self.db.rollback()
+            raise
+        self.db.commit()
+        return sum(len(chunks) for chunks in new.values())
+
 
 class hashie(plugins.Plugin):
     __author__ = 'junohea.mail@gmail.com'
-    __version__ = '1.0.1'
+    __version__ = '1.1.0'
     __license__ = 'GPL3'
     __description__ = '''
                         Attempt to automatically convert pcaps to a crackable format.
@@ -35,7 +188,44 @@ class hashie(plugins.Plugin):
                               location data to revisit networks you need more packets for!
 
                         Additional information:
-                          - Currently requires hcxpcaptool compiled and installed
+                          - By default pcaps are parsed in python (pcap/pcapng with radiotap, PPI,
+                              prism, AVS or raw 802.11 frames), each file is read once through mmap
+                          - Set backend: hcxpcaptool to use hcxpcaptool instead, it is also used as
+                              a fallback for files the python parser cannot read (if installed)
+                          - Set write_22000: true to also save hashcat 22000 lines as *.22000
+                          - Every attempt is recorded in an index (index: /root/.hashie.db), pcaps are
+                              only converted again when they change or the converter is upgraded
+                          - The batch conversion runs in the background, newest pcaps first, and
+                              stops for new handshakes. batch_budget limits it to that many
+                              seconds of work per screen refresh (0 = no limit)
+                          - Set workers above 1 to convert several pcaps at once in a process pool,
+                              workers run at nice/ionice priority and give up on a pcap after
+                              job_timeout seconds
+                          - New handshakes are queued and converted in a background thread once
+                              bettercap has stopped writing to the pcap for debounce seconds,
+                              repeated captures of the same pcap are converted once. The screen
+                              shows the queue depth and how long after its first capture the last
+                              pcap was converted (q3 12s)
+                          - Set store to a path to append every new hash to a single file, deduplicated
+                              by BSSID, client and hash, in hashcat 22000 format (store_format: 22000)
+                              or as <store>.2500 and <store>.16800 (store_format: legacy). With
+                              per_pcap: false no hash files are written next to the pcaps anymore.
+                              Needs the python backend.
+                          - The parser state of every pcap is saved in the index, when bettercap
+                              appends to a pcap only the new records are parsed
+                          - Set compact: true to have the batch job strip every frame no converter
+                              needs from pcaps older than compact_age seconds. Only beacons, probe
+                              responses, (re)association and EAPOL frames are kept (pcap files only)
+                          - Locations of lonely networks are cached in the index and only re-read
+                              when their GPS/GEO/PAW-GPS file changes. Set locations_csv and/or
+                              locations_geojson to export them, and cluster to merge networks
+                              within that many meters into a single point
+                          - Lonely pcaps of the same access point are merged and converted together,
+                              the result is saved as <essid>_<bssid>.merged.2500/.16800 (merge: false
+                              to disable)
+                          - Every ESSID seen in a beacon, probe response or association (or reported
+                              by bettercap) is kept in the index, so a PMKID or handshake can be
+                              completed with an ESSID that was captured in a different pcap
                           - Attempts to repair PMKID hashes when hcxpcaptool cant find the SSID
                             - hcxpcaptool sometimes has trouble extracting the SSID, so we
                                 use the raw 16800 output and attempt to retrieve the SSID via tcpdump
@@ -43,15 +233,61 @@ class hashie(plugins.Plugin):
                                 the reported AP name and MAC to complete the hash
                             - The repair is very basic and could certainly be improved!
                         Todo:
-                          Make it so users dont need hcxpcaptool (unless it gets added to the base image)
-                              Phase 1: Extract/construct 2500/16800 hashes through tcpdump commands
-                              Phase 2: Extract/construct 2500/16800 hashes entirely in python
                           Improve the code, a lot
                         '''
 
     def __init__(self):
         logging.info("[hashie] Plugin loaded.")
         self.lock = Lock()
+        self.backend = 'python'
+        self.write_22000 = False
+        self.analysis = PcapAnalysis()
+        self.index = None
+        self.essids = {}
+        self._learned = {}
+        self.per_pcap = True
+        self.store = None
+        self.compact = False
+        self.compact_age = 600
+        self._locations = {}
+        self.merge = True
+        self.batch_budget = 0
+        self.workers = 1
+        self.debounce = 5
+        self._live = 0
+        self._pending = {}
+        self._queued = Condition()
+        self._latency = None
+        self._tick = Event()
+        self._stop = Event()
+        self._progress = None
+
+    def on_loaded(self):
+        self.backend = self.options.get('backend', 'python')
+        self.write_22000 = self.options.get('write_22000', False)
+        self.batch_budget = self.options.get('batch_budget', 0)
+        self.workers = self.options.get('workers', 1)
+        self.debounce = self.options.get('debounce', 5)
+        self.compact = self.options.get('compact', False)
+        self.compact_age = self.options.get('compact_age', 600)
+        self.merge = self.options.get('merge', True)
+        if self.backend != 'python' and not shutil.which('hcxpcaptool'):
+            logging.warning('[hashie] hcxpcaptool not found, falling back to the python backend.')
+            self.backend = 'python'
+        self.analysis = shared(self.options.get('analysis', ANALYSIS_DB))
+        try:
+            self.index = ConversionIndex(self.options.get('index', '/root/.hashie.db'))
+            self.essids = self.index.essids()
+            self._locations = self.index.locations()
+        except sqlite3.Error as e:
+            logging.warning(f'[hashie] Could not open the conversion index, every pcap will be retried: {e}')
+        if self.options.get('store'):
+            if self.index and self.backend == 'python':
+                self.store = HashStore(self.index.db, self.options['store'], str(self.options.get('store_format', '22000')))
+                self.per_pcap = self.options.get('per_pcap', True)
+            else:
+                logging.warning('[hashie] The hash store needs the python backend and the index, writing per pcap files.')
+        Thread(target=self._handshakeWorker, name='hashie-handshakes', daemon=True).start()
 
     # called when everything is ready and the main loop is about to start
     def on_config_changed(self, config):
@@ -59,29 +295,181 @@ class hashie(plugins.Plugin):
 
         if 'interval' not in self.options or not (self.status.newer_then_hours(self.options['interval'])):
             logging.info('[hashie] Starting batch conversion of pcap files...')
-            with self.lock:
-                self._process_stale_pcaps(handshake_dir)
+            Thread(target=self._process_stale_pcaps, args=(handshake_dir,), name='hashie-batch', daemon=True).start()
+
+    def on_ui_setup(self, ui):
+        position = self.options.get('position', (ui.width() / 2 - 30, 0))
+        ui.add_element('hashie', LabeledValue(color=BLACK, label='', value='', position=tuple(position),
+                                              label_font=fonts.Bold, text_font=fonts.Small))
+
+    def on_unload(self, ui):
+        self._stop.set()
+        self._tick.set()
+        with self._queued:
+            self._queued.notify()
+        with ui._lock:
+            ui.remove_element('hashie')
+
+    def on_ui_update(self, ui):
+        # every refresh hands the batch job a new time slice
+        self._tick.set()
+        progress = self._progress
+        status = []
+        if progress:
+            status.append(f'#{progress[0]}/{progress[1]}')
+        if self._pending:
+            status.append(f'q{len(self._pending)}')
+            if self._latency is not None:
+                status.append(f'{self._latency:.0f}s')
+        ui.set('hashie', ' '.join(status))
 
     def on_handshake(self, agent, filename, access_point, client_station):
+        # bettercap rewrites the pcap a few times per handshake, only queue it here
+        now = time.monotonic()
+        with self._queued:
+            first, last, events, ap = self._pending.get(filename, (now, now, 0, None))
+            self._pending[filename] = (first, now, events + 1, access_point or ap)
+            self._queued.notify()
+
+    def _handshakeWorker(self):
+        # a pcap is converted once it has been quiet for debounce seconds, or at the latest
+        # 12 * debounce seconds after its first event if bettercap keeps writing to it
+        while not self._stop.is_set():
+            with self._queued:
+                now = time.monotonic()
+                due = {filename: min(last + self.debounce, first + self.debounce * 12)
+                       for filename, (first, last, events, ap) in self._pending.items()}
+                ready = [filename for filename, when in due.items() if when <= now]
+                if not ready:
+                    self._queued.wait(timeout=min(due.values()) - now if due else None)
+                    continue
+                jobs = [(filename, self._pending.pop(filename)) for filename in ready]
+                self._live = len(jobs)
+            for filename, (first, last, events, access_point) in jobs:
+                try:
+                    self._handshake(filename, access_point)
+                except Exception as e:
+                    logging.error(f'[hashie] Could not convert {filename}: {e}')
+                self._latency = time.monotonic() - first
+                self._live -= 1
+                logging.info(f'[hashie] Converted {filename} {self._latency:.1f}s after its first capture '
+                              f'({events} events, {len(self._pending)} queued).')
+
+    def _handshake(self, filename, access_point):
         with self.lock:
             handshake_status = []
             fullpathNoExt = filename.split('.')[0]
             name = filename.split('/')[-1:][0].split('.')[0]
 
-            if os.path.isfile(f'{fullpathNoExt}.2500'):
+            if self.per_pcap and os.path.isfile(f'{fullpathNoExt}.2500'):
                 handshake_status.append(f'Already have {name}.2500 (EAPOL)')
-            elif self._writeEAPOL(filename):
+            elif self._writeEAPOL(filename, access_point) and self.per_pcap:
                 handshake_status.append(f'Created {name}.2500 (EAPOL) from pcap')
 
-            if os.path.isfile(f'{fullpathNoExt}.16800'):
+            if self.per_pcap and os.path.isfile(f'{fullpathNoExt}.16800'):
                 handshake_status.append(f'Already have {name}.16800 (PMKID)')
-            elif self._writePMKID(filename, access_point):
+            elif self._writePMKID(filename, access_point) and self.per_pcap:
                 handshake_status.append(f'Created {name}.16800 (PMKID) from pcap')
 
+            if self.write_22000 and self._write22000(filename, access_point):
+                handshake_status.append(f'Created {name}.22000 from pcap')
+
+            capture = self._scan(filename, access_point) if self.store else None
+            added = self._addToStore(filename, capture.entries() if capture else [])
+            if added:
+                handshake_status.append(f'Added {added} new hashes from {name} to {self.store.path}')
+
+            if self.index:
+                self.index.learn_essids(self._learned)
+                self.index.commit()
+            self._learned = {}
+            self.analysis.commit()
+
             if handshake_status:
                 logging.info('[hashie] Good news:\n\t' + '\n\t'.join(handshake_status))
 
-    def _writeEAPOL(self, fullpath):
+    def _scan(self, fullpath, apJSON=""):
+        # the other plugins get the same handshake event, the shared analysis parses the pcap
+        # once per size and mtime for all of them, and only the appended records when it grew
+        try:
+            capture = self.analysis.capture(fullpath)
+        except (OSError, PcapError) as e:
+            logging.debug(f'[hashie] Could not parse {fullpath}: {e}')
+            return None
+        self._learnEssids(capture.essids)
+        if apJSON and apJSON.get('hostname') not in (None, '', '<hidden>'):
+            capture.learn_essid(bytes.fromhex(apJSON['mac'].replace(':', '')), apJSON['hostname'].encode())
+            self._learnEssids(capture.essids)
+        for bssid in capture.wanted():
+            if bssid in self.essids:
+                capture.learn_essid(bssid, self.essids[bssid])
+        return capture
+
+    def _learnEssids(self, essids):
+        learned = {bssid: essid for bssid, essid in essids.items() if self.essids.get(bssid) != essid}
+        self.essids.update(learned)
+        self._learned.update(learned)
+
+    def _addToStore(self, pcap, entries):
+        if not self.store:
+            return 0
+        try:
+            return self.store.add(pcap, entries)
+        except (OSError, sqlite3.Error) as e:
+            logging.error(f'[hashie] Could not add hashes from {pcap} to {self.store.path}: {e}')
+            return 0
+
+    def _converter(self):
+        store = f'{self.store.path}:{self.store.format}' if self.store else ''
+        return f'{self.backend}:{PARSER_VERSION}:{int(self.write_22000)}:{int(self.per_pcap)}:{store}'
+
+    def _useHcx(self, capture):
+        return self.backend != 'python' or (capture is None and shutil.which('hcxpcaptool'))
+
+    def _writeEAPOL(self, fullpath, apJSON=""):
+        capture = self._scan(fullpath, apJSON) if self.backend == 'python' else None
+        if self._useHcx(capture):
+            return self._writeEAPOLhcx(fullpath)
+        fullpathNoExt = fullpath.split('.')[0]
+        filename = fullpath.split('/')[-1:][0].split('.')[0]
+        records = capture.hccapx() if capture else b''
+        if records:
+            if self.per_pcap:
+                with open(f'{fullpathNoExt}.2500', 'wb') as hccapx:
+                    hccapx.write(records)
+                logging.debug(f'[hashie] [+] EAPOL Success: {filename}.2500 created.')
+            return True
+
+        return False
+
+    def _writePMKID(self, fullpath, apJSON):
+        capture = self._scan(fullpath, apJSON) if self.backend == 'python' else None
+        if self._useHcx(capture):
+            return self._writePMKIDhcx(fullpath, apJSON)
+        fullpathNoExt = fullpath.split('.')[0]
+        filename = fullpath.split('/')[-1:][0].split('.')[0]
+        lines = capture.pmkid_lines() if capture else []
+        if lines:
+            if self.per_pcap:
+                with open(f'{fullpathNoExt}.16800', 'w') as pmkid:
+                    pmkid.write('\n'.join(lines) + '\n')
+                logging.debug(f'[hashie] [+] PMKID Success: {filename}.16800 created.')
+            return True
+
+        return False
+
+    def _write22000(self, fullpath, apJSON=""):
+        fullpathNoExt = fullpath.split('.')[0]
+        capture = self._scan(fullpath, apJSON)
+        lines = capture.lines_22000() if capture else []
+        if lines:
+            with open(f'{fullpathNoExt}.22000', 'w') as hashes:
+                hashes.write('\n'.join(lines) + '\n')
+            return True
+
+        return False
+
+    def _writeEAPOLhcx(self, fullpath):
         fullpathNoExt = fullpath.split('.')[0]
         filename = fullpath.split('/')[-1:][0].split('.')[0]
         result = subprocess.getoutput(f'hcxpcaptool -o {fullpathNoExt}.2500 {fullpath} >/dev/null 2>&1')
@@ -92,7 +480,7 @@ class hashie(plugins.Plugin):
 
         return False
 
-    def _writePMKID(self, fullpath, apJSON):
+    def _writePMKIDhcx(self, fullpath, apJSON):
         fullpathNoExt = fullpath.split('.')[0]
         filename = fullpath.split('/')[-1:][0].split('.')[0]
         result = subprocess.getoutput(f'hcxpcaptool -k {fullpathNoExt}.16800 {fullpath} >/dev/null 2>&1')
@@ -121,8 +509,15 @@ class hashie(plugins.Plugin):
         logging.debug(f'[hashie] Repairing {filename}...')
         with open(f'{fullpathNoExt}.16800', 'r') as tempFileA:
             hashString = tempFileA.read()
-        if apJSON != "":
-            clientString.append(f"{apJSON['mac'].replace(':', '')}:{apJSON['hostname'].encode('hex')}")
+        apMac = hashString.split(':')[1] if hashString.count(':') >= 2 else ''
+        try:
+            essid = self.essids.get(bytes.fromhex(apMac))
+        except ValueError:
+            essid = None
+        if essid: #seen before, in this or any other capture
+            clientString.append(f'{apMac}:{essid.hex()}')
+        elif apJSON != "":
+            clientString.append(f"{apJSON['mac'].replace(':', '')}:{apJSON['hostname'].encode().hex()}")
         else:
             #attempt to extract the AP's name via hcxpcaptool
             result = subprocess.getoutput(f'hcxpcaptool -X /tmp/{filename} {fullpath} >/dev/null 2>&1')
@@ -138,6 +533,11 @@ class hashie(plugins.Plugin):
                 for i in tcpCatOut.split('\n'):
                     if ":" in i:
                         clientString.append(i.split('\t')[0].replace(':', '') + ':' + i.split('\t')[1].strip('\n').encode().hex())
+            for line in clientString:
+                try:
+                    self._learnEssids({bytes.fromhex(line.split(':')[0]): bytes.fromhex(line.split(':')[1])})
+                except (ValueError, IndexError):
+                    pass
         if clientString:
             for line in clientString:
                 if line.split(':')[0] == hashString.split(':')[1]: #if the AP MAC pulled from the JSON or tcpdump output matches the AP MAC in the raw 16800 output
@@ -153,70 +553,312 @@ class hashie(plugins.Plugin):
             os.remove(f"{fullpath.split('.')[0]}.16800")
             return False
 
+    def _waitForSlice(self, sliceStart):
+        # let live handshakes go first, then stay within batch_budget seconds per screen refresh
+        while (self._live or self._pending) and not self._stop.is_set():
+            time.sleep(0.1)
+        if self.batch_budget and time.monotonic() - sliceStart >= self.batch_budget:
+            self._tick.clear()
+            self._tick.wait(timeout=60)
+            return time.monotonic()
+        return sliceStart
+
+    def _batchPool(self):
+        # fork so the workers inherit this instance, the plugin module itself can't be imported by name
+        forkpool.bind(self)
+        return ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('fork'),
+                                   initializer=forkpool.init,
+                                   initargs=(self.options.get('nice', 10), self.options.get('ionice', 3), '_batchWorkerSetup'))
+
+    def _batchWorkerSetup(self):
+        # the sqlite connections belong to the parent, workers hand everything back through their results
+        self.index = None
+        self.analysis = PcapAnalysis()
+
     def _process_stale_pcaps(self, handshake_dir):
-        handshakes_list = [os.path.join(handshake_dir, filename) for filename in os.listdir(handshake_dir) if filename.endswith('.pcap')]
+        with os.scandir(handshake_dir) as entries:
+            pcaps = [(entry.stat().st_mtime, entry.path) for entry in entries if entry.name.endswith('.pcap')]
+        handshakes_list = [path for mtime, path in sorted(pcaps, reverse=True)] #newest first
         failed_jobs = []
         successful_jobs = []
         lonely_pcaps = []
-        for num, handshake in enumerate(handshakes_list):
-            fullpathNoExt = handshake.split('.')[0]
-            pcapFileName = handshake.split('/')[-1:][0]
-            if not os.path.isfile(f'{fullpathNoExt}.2500'): #if no 2500, try
-                if self._writeEAPOL(handshake):
-                    successful_jobs.append(f'2500: {pcapFileName}')
-                else:
-                    failed_jobs.append(f'2500: {pcapFileName}')
-            if not os.path.isfile(f'{fullpathNoExt}.16800'): #if no 16800, try
-                if self._writePMKID(handshake, ""):
-                    successful_jobs.append(f'16800: {pcapFileName}')
-                else:
-                    failed_jobs.append(f'16800: {pcapFileName}')
-                    if not os.path.isfile(f'{fullpathNoExt}.2500'): #if no 16800 AND no 2500
-                        lonely_pcaps.append(handshake)
-                        logging.debug(f'[hashie] Batch job: added {pcapFileName} to lonely list.')
-            if ((num + 1) % 50 == 0) or (num + 1 == len(handshakes_list)): #report progress every 50, or when done
-                logging.info(f'[hashie] Batch job: {num + 1}/{len(handshakes_list)} done ({len(lonely_pcaps)} fails).')
+        skipped = 0
+        done = 0
+        compacted = [0, 0, 0]
+        converter = self._converter()
+        timeout = self.options.get('job_timeout', 60)
+        pool = self._batchPool() if self.workers > 1 else None
+        pending = deque()
+        sliceStart = time.monotonic()
+        self._progress = (0, len(handshakes_list))
+
+        def merge(handshake, st, known, result):
+            nonlocal done, skipped
+            if result and result[7]:
+                compacted[0] += 1
+                compacted[1] += result[7][0]
+                compacted[2] += result[7][1]
+                st = os.stat(handshake)
+            with self.lock:
+                self._mergeStale(handshake, st, converter, known, result, successful_jobs, failed_jobs, lonely_pcaps)
+                if self.index and result and result[7] is not None:
+                    self.index.mark_compacted(handshake, st)
+            done += 1
+            skipped += known is not None
+            self._progress = (done, len(handshakes_list))
+            if (done % 50 == 0) or (done == len(handshakes_list)): #report progress every 50, or when done
+                logging.info(f'[hashie] Batch job: {done}/{len(handshakes_list)} done ({len(lonely_pcaps)} fails).')
+                if self.index:
+                    with self.lock:
+                        self.index.commit()
+
+        def collect(handshake, st, known, future):
+            try:
+                result = future.result(timeout=timeout + 5)
+                if result is None:
+                    logging.info(f'[hashie] Batch job: gave up on {handshake} after {timeout}s.')
+            except FutureTimeout:
+                logging.info(f'[hashie] Batch job: gave up on {handshake} after {timeout}s.')
+                result = None
+            except Exception as e:
+                # left out of the index like a timeout, so it is retried next time
+                logging.error(f'[hashie] Batch job: {handshake} failed: {e!r}')
+                result = None
+            merge(handshake, st, known, result)
+
+        try:
+            for handshake in handshakes_list:
+                sliceStart = self._waitForSlice(sliceStart)
+                if self._stop.is_set():
+                    logging.info(f'[hashie] Batch job: stopped after {done}/{len(handshakes_list)}.')
+                    break
+                with self.lock:
+                    try:
+                        st = os.stat(handshake)
+                    except OSError:
+                        continue
+                    known = self.index.lookup(handshake, st, converter, self.essids) if self.index else None
+                    compact = self.compact and not (self.index and self.index.compacted(handshake, st))
+                    if not pool:
+                        result = self._convertStale(handshake, known, compact)
+                if not pool:
+                    merge(handshake, st, known, result)
+                    continue
+                pending.append((handshake, st, known, pool.submit(forkpool.call, '_convertStale', handshake, known, compact,
+                                                                          timeout=timeout)))
+                if len(pending) >= self.workers:
+                    collect(*pending.popleft())
+            while pending:
+                collect(*pending.popleft())
+        finally:
+            if pool:
+                pool.shutdown(wait=False)
+        self._progress = None
+        if self.index and not self._stop.is_set():
+            with self.lock:
+                self.index.prune(handshakes_list)
+                self.index.commit()
+            self.analysis.prune(handshake_dir, handshakes_list)
+        if skipped:
+            logging.info(f'[hashie] Batch job: {skipped} pcaps unchanged since their last conversion.')
+        if compacted[0]:
+            logging.info(f'[hashie] Batch job: compacted {compacted[0]} pcaps from {compacted[1] // 1024}KB '
+                         f'to {compacted[2] // 1024}KB.')
         if successful_jobs:
             logging.info(f'[hashie] Batch job: {len(successful_jobs)} new handshake files created.')
+        if lonely_pcaps and self.merge and not self._stop.is_set():
+            lonely_pcaps = self._mergeLonely(handshake_dir, lonely_pcaps)
         if lonely_pcaps:
             logging.info(f'[hashie] Batch job: {len(lonely_pcaps)} networks without enough packets to create a hash.')
             self._getLocations(lonely_pcaps)
 
-    def _getLocations(self, lonely_pcaps):
-        #export a file for webgpsmap to load
-        with open('/root/.incompletePcaps', 'w') as isIncomplete:
-            count = 0
+    def _mergeLonely(self, handshake_dir, lonely_pcaps):
+        """Group the lonely pcaps by BSSID and convert every group as one capture, half a handshake
+        in one pcap and the other half in another still make a hash. Returns the pcaps still lonely."""
+        groups = {}
+        captures = {}
+        with self.lock:
             for pcapFile in lonely_pcaps:
-                filename = pcapFile.split('/')[-1:][0] #keep extension
-                fullpathNoExt = pcapFile.split('.')[0]
-                isIncomplete.write(f'{filename}\n')
-                if os.path.isfile(f'{fullpathNoExt}.gps.json') or os.path.isfile(f'{fullpathNoExt}.geo.json') or os.path.isfile(f'{fullpathNoExt}.paw-gps.json'):
-                    count += 1
-            if count != 0:
-                logging.info(f'[hashie] Used {str(count)} GPS/GEO/PAW-GPS files to find lonely networks, go check webgpsmap! ;)')
+                capture = self._scan(pcapFile)
+                if capture:
+                    captures[pcapFile] = capture
+                    for bssid in capture.bssids():
+                        groups.setdefault(bssid, []).append(pcapFile)
+        resolved = set()
+        created = 0
+        for bssid, members in groups.items():
+            if len(members) < 2:
+                continue
+            with self.lock:
+                merged = CaptureInfo.merged(captures[member] for member in members)
+                if bssid not in merged.essids and bssid in self.essids:
+                    merged.learn_essid(bssid, self.essids[bssid])
+                entries = [entry for entry in merged.entries() if entry[0] == bssid]
+                if not entries:
+                    continue
+                essid = merged.essids[bssid].decode('utf-8', 'replace').replace('/', '_')
+                name = os.path.join(handshake_dir, f'{essid}_{bssid.hex()}.merged')
+                if self.per_pcap:
+                    for ext in ('2500', '16800'):
+                        records = b''.join(entry[5] for entry in entries if entry[4] == ext)
+                        if records:
+                            with open(f'{name}.{ext}', 'wb') as hashes:
+                                hashes.write(records)
+                if self.write_22000:
+                    with open(f'{name}.22000', 'w') as hashes:
+                        hashes.write(''.join(f'{entry[3]}\n' for entry in entries))
+                self._addToStore(f'{name}.pcap', entries)
+            # the hashes are made of MICs, ANonces and PMKIDs, a pcap none of them came from is still lonely
+            parts = {bytes.fromhex(part) for entry in entries for part in entry[3].split('*')[2:7:4] if part}
+            used = [member for member in members if captures[member].messages(bssid) & parts]
+            logging.debug(f'[hashie] Batch job: merged {len(used)} pcaps of {bssid.hex()} into {name}.')
+            resolved.update(used)
+            created += 1
+        if created:
+            logging.info(f'[hashie] Batch job: {created} networks completed by merging {len(resolved)} lonely pcaps.')
+        return [pcapFile for pcapFile in lonely_pcaps if pcapFile not in resolved]
+
+    def _convertStale(self, handshake, known, compact=False):
+        """Convert a single pcap for the batch job, may run in a pool worker, and compact it with compact.
+        Returns (successful, failed, hasEAPOL, hasPMKID, learned ESSIDs, wanted BSSIDs, store entries,
+        compacted (before, after) sizes, () if there was nothing to drop or None if it wasn't compacted)."""
+        fullpathNoExt = handshake.split('.')[0]
+        pcapFileName = handshake.split('/')[-1:][0]
+        successful = []
+        failed = []
+        # an unchanged pcap (known) needs no parse unless its hashes go to the store
+        capture = self._scan(handshake) if self.backend == 'python' and (not known or self.store) else None
+        hasEAPOL = os.path.isfile(f'{fullpathNoExt}.2500') if self.per_pcap else bool(known and known[0])
+        if not hasEAPOL and not (known and not known[0]): #if no 2500, try
+            hasEAPOL = self._writeEAPOL(handshake)
+            if hasEAPOL:
+                successful.append(f'2500: {pcapFileName}')
+            else:
+                failed.append(f'2500: {pcapFileName}')
+        hasPMKID = os.path.isfile(f'{fullpathNoExt}.16800') if self.per_pcap else bool(known and known[1])
+        if not hasPMKID and not (known and not known[1]): #if no 16800, try
+            hasPMKID = self._writePMKID(handshake, "")
+            if hasPMKID:
+                successful.append(f'16800: {pcapFileName}')
             else:
-                logging.info('[hashie] Could not find any GPS/GEO/PAW-GPS files for the lonely networks.')
+                failed.append(f'16800: {pcapFileName}')
+        if self.write_22000 and not os.path.isfile(f'{fullpathNoExt}.22000') and not known:
+            self._write22000(handshake)
+        learned, self._learned = self._learned, {}
+        stored = list(capture.entries()) if self.store and capture else []
+        compacted = None
+        if compact and handshake not in self._pending and time.time() - os.path.getmtime(handshake) > self.compact_age:
+            try:
+                compacted = compact_pcap(handshake) or ()
+            except (OSError, ValueError, IndexError, struct.error) as e:
+                logging.debug(f'[hashie] Could not compact {pcapFileName}: {e}')
+        return (successful, failed, hasEAPOL, hasPMKID, learned, capture.wanted() if capture else set(), stored,
+                compacted)
+
+    def _mergeStale(self, handshake, st, converter, known, result, successful_jobs, failed_jobs, lonely_pcaps):
+        pcapFileName = handshake.split('/')[-1:][0]
+        if result is None: #timed out, leave it out of the index so it is retried
+            failed_jobs.append(f'timeout: {pcapFileName}')
+            return
+        successful, failed, hasEAPOL, hasPMKID, learned, wanted, stored, compacted = result
+        successful_jobs.extend(successful)
+        failed_jobs.extend(failed)
+        if not hasEAPOL and not hasPMKID: #if no 16800 AND no 2500
+            lonely_pcaps.append(handshake)
+            logging.debug(f'[hashie] Batch job: added {pcapFileName} to lonely list.')
+        self.essids.update(learned)
+        self._addToStore(handshake, stored)
+        if self.index:
+            self.index.learn_essids(learned)
+            if known != (hasEAPOL, hasPMKID) or wanted or compacted:
+                self.index.record(handshake, st, converter, hasEAPOL, hasPMKID, wanted)
 
-    def _getLocationsCSV(self, lonely_pcaps):
-        #in case we need this later, export locations manually to CSV file, needs try/catch/paw-gps format/etc.
+    def _getLocations(self, lonely_pcaps):
+        #export a file for webgpsmap to load
+        self._writeIfChanged(self.options.get('incomplete', '/root/.incompletePcaps'),
+                             (f"{pcapFile.split('/')[-1:][0]}\n" for pcapFile in lonely_pcaps))
+        locations = self._lonelyLocations(lonely_pcaps)
+        if locations:
+            logging.info(f'[hashie] Used {len(locations)} GPS/GEO/PAW-GPS files to find lonely networks, go check webgpsmap! ;)')
+        else:
+            logging.info('[hashie] Could not find any GPS/GEO/PAW-GPS files for the lonely networks.')
+        if locations and self.options.get('locations_csv'):
+            self._getLocationsCSV(locations)
+        if locations and self.options.get('locations_geojson'):
+            self._getLocationsGeoJSON(locations)
+
+    def _lonelyLocations(self, lonely_pcaps):
+        """Return (name, lat, lng, accuracy) for every lonely pcap with a location sidecar.
+        Sidecars are listed with one scandir per folder and only parsed when their mtime changed."""
+        sidecars = {}
+        for folder in {os.path.dirname(pcapFile) for pcapFile in lonely_pcaps}:
+            with os.scandir(folder or '.') as entries:
+                sidecars.update((entry.path, entry.stat().st_mtime) for entry in entries if entry.name.endswith('.json'))
         locations = []
         for pcapFile in lonely_pcaps:
             filename = pcapFile.split('/')[-1:][0].split('.')[0]
             fullpathNoExt = pcapFile.split('.')[0]
-            if os.path.isfile(f'{fullpathNoExt}.gps.json'):
-                with open(f'{fullpathNoExt}.gps.json', 'r') as tempFileA:
-                    data = json.load(tempFileA)
-                    locations.append(f"{filename},{str(data['Latitude'])},{str(data['Longitude'])},50")
-            elif os.path.isfile(f'{fullpathNoExt}.geo.json'):
-                with open(f'{fullpathNoExt}.geo.json', 'r') as tempFileB:
-                    data = json.load(tempFileB)
-                    locations.append(f"{filename},{str(data['location']['lat'])},{str(data['location']['lng'])},{str(data['accuracy'])}")
-            elif os.path.isfile(f'{fullpathNoExt}.paw-gps.json'):
-                with open(f'{fullpathNoExt}.paw-gps.json', 'r') as tempFileC:
-                    data = json.load(tempFileC)
-                    locations.append(f"{filename},{str(data['lat'])},{str(data['long'])},50")
-        if locations:
-            with open('/root/locations.csv', 'w') as tempFileD:
-                for loc in locations:
-                    tempFileD.write(f'{loc}\n')
-            logging.info(f'[hashie] Used {len(locations)} GPS/GEO files to find lonely networks, load /root/locations.csv into a mapping app and go say hi!')
+            for ext, read in LOCATION_SIDECARS:
+                sidecar = f'{fullpathNoExt}.{ext}'
+                if sidecar not in sidecars:
+                    continue
+                cached = self._locations.get(pcapFile)
+                if cached and cached[0] == sidecar and cached[1] == sidecars[sidecar]:
+                    locations.append((filename, *cached[2:]))
+                    break
+                try:
+                    with open(sidecar, 'r') as sidecarFile:
+                        lat, lng, accuracy = (float(value) for value in read(json.load(sidecarFile)))
+                except (OSError, ValueError, KeyError, TypeError) as e:
+                    logging.debug(f'[hashie] Could not read {sidecar}: {e}')
+                    continue
+                self._locations[pcapFile] = (sidecar, sidecars[sidecar], lat, lng, accuracy)
+                if self.index:
+                    with self.lock:
+                        self.index.save_location(pcapFile, sidecar, sidecars[sidecar], lat, lng, accuracy)
+                locations.append((filename, lat, lng, accuracy))
+                break
+        if self.index:
+            with self.lock:
+                self.index.commit()
+        return locations
+
+    def _clustered(self, locations):
+        if self.options.get('cluster'):
+            return cluster_locations(locations, self.options['cluster'])
+        return (([name], lat, lng, accuracy) for name, lat, lng, accuracy in locations)
+
+    def _getLocationsCSV(self, locations):
+        path = self.options['locations_csv']
+        self._writeIfChanged(path, (f"{';'.join(names)},{lat},{lng},{accuracy}\n"
+                                    for names, lat, lng, accuracy in self._clustered(locations)))
+        logging.info(f'[hashie] Used {len(locations)} GPS/GEO files to find lonely networks, load {path} into a mapping app and go say hi!')
+
+    def _getLocationsGeoJSON(self, locations):
+        def features():
+            yield '{"type": "FeatureCollection", "features": [\n'
+            for num, (names, lat, lng, accuracy) in enumerate(self._clustered(locations)):
+                feature = {'type': 'Feature', 'geometry': {'type': 'Point', 'coordinates': [lng, lat]},
+                           'properties': {'pcaps': names, 'count': len(names), 'accuracy': accuracy}}
+                yield (',\n' if num else '') + json.dumps(feature)
+            yield '\n]}\n'
+        self._writeIfChanged(self.options['locations_geojson'], features())
+
+    @staticmethod
+    def _writeIfChanged(path, chunks):
+        # stream to a temporary file and only replace the export if its content changed
+        tmp = f'{path}.tmp'
+        digest = hashlib.sha1()
+        with open(tmp, 'w') as export:
+            for chunk in chunks:
+                export.write(chunk)
+                digest.update(chunk.encode())
+        try:
+            with open(path, 'rb') as current:
+                unchanged = hashlib.sha1(current.read()).digest() == digest.digest()
+        except OSError:
+            unchanged = False
+        if unchanged:
+            os.remove(tmp)
+        else:
+            os.replace(tmp, path)
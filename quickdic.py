@@ -1,24 +1,218 @@
+import glob
+import hashlib
+import importlib.util
+import json
 import logging
+import os
 import re
-import string
+import shutil
 import subprocess
+import sqlite3
+import sys
+import time
+from threading import Event, Lock, Thread
 
 import pwnagotchi.plugins as plugins
 
-# Aircrack-ng needed, to install:
+# the capture parser is shared with the other plugins in this folder
+_WPATOOLS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'wpatools')
+if 'wpatools' not in sys.modules:
+    # loaded by path: with this folder on sys.path "import telegram" would find telegram.py
+    _spec = importlib.util.spec_from_file_location('wpatools', os.path.join(_WPATOOLS, '__init__.py'),
+                                                   submodule_search_locations=[_WPATOOLS])
+    sys.modules['wpatools'] = importlib.util.module_from_spec(_spec)
+    _spec.loader.exec_module(sys.modules['wpatools'])
+from wpatools.analysis import ANALYSIS_DB, PcapAnalysis, shared  # noqa: E402
+from wpatools.crack import check_batch, crack, pmk, targets  # noqa: E402
+from wpatools.pcap import PcapError  # noqa: E402
+from wpatools.mask import Mask  # noqa: E402
+from wpatools.pmkdb import PMKStore  # noqa: E402
+from wpatools.remote import reachable  # noqa: E402
+from wpatools.rules import Candidates, bssid_candidates, load_rules  # noqa: E402
+from wpatools import wordlist  # noqa: E402
+
+# The python engine needs nothing else. For engine: aircrack-ng, install it with:
 # > apt-get install aircrack-ng
 # Upload wordlist files in .txt format to folder in config file (Default: /opt/wordlists/)
 # Cracked handshakes stored in handshake folder as [essid].pcap.cracked
 
 
+def power():
+    """'charging' if a power supply reports charging or full, 'battery' if one is discharging,
+    None if there is no battery to tell (plain usb power)."""
+    states = set()
+    for status in glob.glob('/sys/class/power_supply/*/status'):
+        try:
+            with open(status) as f:
+                states.add(f.read().strip())
+        except OSError:
+            pass
+    if states & {'Charging', 'Full'}:
+        return 'charging'
+    if 'Discharging' in states:
+        return 'battery'
+    return None
+
+
+class JobQueue:
+    """SQLite queue of (pcap, BSSID) cracking jobs with how far into which wordlist each one got
+    and how much time it has spent, so jobs survive reboots and pick up where they stopped."""
+
+    def __init__(self, path):
+        self.lock = Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS jobs (pcap TEXT, bssid BLOB, essid BLOB, state TEXT, wordlist TEXT, '
+                        'position INTEGER, spent REAL, added REAL, ap TEXT, hashes TEXT, PRIMARY KEY (pcap, bssid))')
+        columns = [column[1] for column in self.db.execute('PRAGMA table_info(jobs)')]
+        for column in ('ap', 'hashes'):
+            if column not in columns:
+                self.db.execute(f'ALTER TABLE jobs ADD COLUMN {column} TEXT')
+        self.db.commit()
+
+    def add(self, pcap, bssid, essid, lines, access_point=None):
+        """Queue a job, or requeue it from the start if the pcap brought new hashes (lines, their hashcat 22000
+        lines) for a job that ran out of words or time. access_point is bettercap's, handed to the cracked event later."""
+        fingerprint = hashlib.sha1('\n'.join(sorted(lines)).encode()).hexdigest()
+        # the same pcap seen again, e.g. on every handshake event of its AP, is no reason to start over
+        requeue = "state IN ('exhausted', 'budget') AND hashes IS NOT excluded.hashes"
+        with self.lock:
+            self.db.execute("INSERT INTO jobs VALUES (?, ?, ?, 'queued', NULL, 0, 0, ?, ?, ?) ON CONFLICT(pcap, bssid) DO UPDATE "
+                            f"SET essid = excluded.essid, ap = COALESCE(excluded.ap, ap), hashes = excluded.hashes, "
+                            f"state = CASE WHEN {requeue} THEN 'queued' ELSE state END, "
+                            f"position = CASE WHEN {requeue} THEN 0 ELSE position END, "
+                            f"spent = CASE WHEN {requeue} THEN 0 ELSE spent END",
+                            (pcap, bssid, essid, time.time(), json.dumps(access_point) if access_point else None, fingerprint))
+            self.db.commit()
+
+    def access_point(self, pcap, bssid):
+        """bettercap's access_point of the job, or None if it was queued without one."""
+        with self.lock:
+            row = self.db.execute('SELECT ap FROM jobs WHERE pcap = ? AND bssid = ?', (pcap, bssid)).fetchone()
+        return json.loads(row[0]) if row and row[0] else None
+
+    def next(self, wordlist, budget):
+        """The next job as (pcap, bssid, essid, position in wordlist, seconds spent), or None. Jobs for the
+        ESSIDs seen in the most pcaps go first, jobs that ran out of words or time come back from the
+        start for new candidates (wordlist, rules or masks) and jobs that ran out of time for a bigger budget."""
+        with self.lock:
+            row = self.db.execute("SELECT pcap, bssid, essid, wordlist, position, spent FROM jobs AS job "
+                                  "WHERE state = 'queued' OR (state IN ('exhausted', 'budget') AND wordlist != ?) "
+                                  "OR (state = 'budget' AND (? = 0 OR spent < ?)) "
+                                  "ORDER BY (SELECT COUNT(*) FROM jobs WHERE essid = job.essid) DESC, added "
+                                  "LIMIT 1", (wordlist, budget, budget)).fetchone()
+        if not row:
+            return None
+        pcap, bssid, essid, filled, position, spent = row
+        if filled != wordlist:
+            return pcap, bytes(bssid), bytes(essid), 0, 0
+        return pcap, bytes(bssid), bytes(essid), position, spent
+
+    def update(self, pcap, bssid, state, wordlist=None, position=0, spent=0):
+        with self.lock:
+            self.db.execute('UPDATE jobs SET state = ?, wordlist = ?, position = ?, spent = ? WHERE pcap = ? AND bssid = ?',
+                            (state, wordlist, position, spent, pcap, bssid))
+            self.db.commit()
+
+    def siblings(self, essid, wordlist, position):
+        """Other queued jobs of essid that are at position in wordlist, as (pcap, bssid, spent)."""
+        with self.lock:
+            rows = self.db.execute("SELECT pcap, bssid, wordlist, position, spent FROM jobs WHERE essid = ? AND state = 'queued'",
+                                   (essid,)).fetchall()
+        return [(pcap, bytes(bssid), spent) for pcap, bssid, filled, at, spent in rows
+                if (at if filled == wordlist else 0) == position]
+
+    def pending(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM jobs WHERE state = 'queued'").fetchone()[0]
+
+
+class Potfile:
+    """Every key found so far by BSSID and ESSID, in the job queue's database. Imported from the
+    <pcap>.cracked files too, so keys found by aircrack-ng or before the index existed count."""
+
+    def __init__(self, db, lock):
+        self.db = db
+        self.lock = lock
+        self.db.execute('CREATE TABLE IF NOT EXISTS potfile (bssid BLOB, essid BLOB, key BLOB, found REAL, '
+                        'PRIMARY KEY (bssid, essid, key))')
+        self.db.execute('CREATE INDEX IF NOT EXISTS potfile_essid ON potfile (essid)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS imported (path TEXT PRIMARY KEY, mtime REAL)')
+        self.db.commit()
+
+    def add(self, bssid, essid, key):
+        with self.lock:
+            self.db.execute('INSERT OR IGNORE INTO potfile VALUES (?, ?, ?, ?)', (bssid, essid, key, time.time()))
+            self.db.commit()
+
+    def keys(self, bssid, essid):
+        """Known keys worth a try for this AP: its own first, then those of other APs with its ESSID."""
+        with self.lock:
+            rows = self.db.execute('SELECT DISTINCT key, bssid = ? FROM potfile WHERE bssid = ? OR essid = ? '
+                                   'ORDER BY bssid = ? DESC, found DESC', (bssid, bssid, essid, bssid)).fetchall()
+        return list(dict.fromkeys(bytes(key) for key, own in rows))
+
+    def import_cracked(self, handshake_dir, analysis):
+        """Read the <essid>_<bssid>.pcap.cracked files of handshake_dir that are new or changed since the
+        last import into the potfile, returns how many keys were new."""
+        added = 0
+        try:
+            with os.scandir(handshake_dir) as entries:
+                cracked = {entry.path: entry.stat().st_mtime for entry in entries if entry.name.endswith('.pcap.cracked')}
+        except OSError:
+            return 0
+        with self.lock:
+            imported = dict(self.db.execute('SELECT path, mtime FROM imported').fetchall())
+        for path, mtime in cracked.items():
+            if imported.get(path) == mtime:
+                continue
+            with self.lock:
+                self.db.execute('INSERT OR REPLACE INTO imported VALUES (?, ?)', (path, mtime))
+            pcap = path[:-len('.cracked')]
+            name = os.path.basename(pcap)[:-len('.pcap')]
+            try:
+                bssid = bytes.fromhex(name.rsplit('_', 1)[-1])
+                with open(path, 'rb') as f:
+                    key = f.read().strip()
+            except (OSError, ValueError):
+                continue
+            if len(bssid) != 6 or not 8 <= len(key) <= 63:
+                continue
+            try:
+                essid = analysis.capture(pcap).essids.get(bssid) or name.rsplit('_', 1)[0].encode()
+            except (OSError, PcapError):
+                essid = name.rsplit('_', 1)[0].encode()
+            with self.lock:
+                added += self.db.execute('INSERT OR IGNORE INTO potfile VALUES (?, ?, ?, ?)',
+                                         (bssid, essid, key, mtime)).rowcount
+        with self.lock:
+            self.db.commit()
+        return added
+
+
 class QuickDic(plugins.Plugin):
     __author__ = 'pwnagotchi [at] rossmarks [dot] uk'
-    __version__ = '1.0.0'
+    __version__ = '1.10.0'
     __license__ = 'GPL3'
     __description__ = 'Run a quick dictionary scan against captured handshakes'
 
     def __init__(self):
         self.text_to_set = ""
+        self.engine = 'python'
+        self.analysis = PcapAnalysis()
+        self.pmks = None
+        self.jobs = None
+        self.potfile = None
+        self._agent = None
+        self._cracking = 0
+        self._wordlist = None
+        self._candidates = None
+        self._candidatesKey = None
+        self._rulesError = None
+        self._compiling = Lock()
+        self._idleUntil = 0
+        self._importFrom = None
+        self._wake = Event()
+        self._stop = Event()
 
     def on_loaded(self):
         logging.info("Quick dictionary check plugin loaded")
@@ -26,34 +220,329 @@ class QuickDic(plugins.Plugin):
         if 'face' not in self.options:
             self.options['face'] = '(·ω·)'
 
-        check = subprocess.run(
-            ('/usr/bin/dpkg -l aircrack-ng | grep aircrack-ng | awk \'{print $2, $3}\''), shell=True, stdout=subprocess.PIPE)
-        check = check.stdout.decode('utf-8').strip()
-        if check != "aircrack-ng <none>":
-            logging.info("quickdic: Found " + check)
+        self.engine = self.options.get('engine', 'python')
+        if self.engine == 'aircrack-ng':
+            if shutil.which('aircrack-ng'):
+                logging.info(f"quickdic: Using {shutil.which('aircrack-ng')}")
+            else:
+                logging.warning("aircrack-ng is not installed, falling back to the python engine!")
+                self.engine = 'python'
+        self.analysis = shared(self.options.get('analysis', ANALYSIS_DB))
+        if self.options.get('pmk_db', '/root/.quickdic-pmk.db'):
+            try:
+                self.pmks = PMKStore(self.options.get('pmk_db', '/root/.quickdic-pmk.db'))
+            except sqlite3.Error as e:
+                logging.warning(f"[quickdic] Could not open the PMK database: {e}")
+        try:
+            self.jobs = JobQueue(self.options.get('jobs', '/root/.quickdic-jobs.db'))
+            self.potfile = Potfile(self.jobs.db, self.jobs.lock)
+        except sqlite3.Error as e:
+            logging.error(f"[quickdic] Could not open the job queue, nothing will be cracked: {e}")
+            return
+        Thread(target=self._jobWorker, name='quickdic-jobs', daemon=True).start()
+
+    # called when everything is ready and the main loop is about to start
+    def on_config_changed(self, config):
+        # the job worker imports the .cracked files, off the agent's thread
+        self._importFrom = config['bettercap']['handshakes']
+        self._wake.set()
+
+    def on_unload(self, ui):
+        self._stop.set()
+        self._wake.set()
+
+    # the agent is idle for t seconds, a good time to crack or precompute PMKs
+    def on_sleep(self, agent, t):
+        self._idleUntil = time.monotonic() + t
+        self._wake.set()
+
+    def on_wait(self, agent, t):
+        self._idleUntil = time.monotonic() + t
+        self._wake.set()
+
+    def _wordlists(self):
+        """The compiled wordlist, rebuilt first if a list in wordlist_folder changed."""
+        with self._compiling:
+            folder = self.options['wordlist_folder']
+            order = self.options.get('order', 'source')
+            current = self._wordlist
+            if current is None or current.version != wordlist.sources_version(folder, order):
+                start = time.monotonic()
+                self._wordlist = wordlist.load(folder, self.options.get('compiled', '/root/.quickdic.wordlist'), order)
+                if current is None or self._wordlist.version != current.version:
+                    logging.info(f"[quickdic] Wordlist has {len(self._wordlist)} candidates "
+                                 f"({time.monotonic() - start:.1f}s to load)")
+            return self._wordlist
+
+    def _mayRun(self):
+        """Whether cracking may use the CPU right now, given the load and the power source."""
+        # the load our own workers add doesn't count
+        if os.getloadavg()[0] - self._cracking > self.options.get('max_load', 1.5):
+            return False
+        if power() == 'battery':
+            policy = self.options.get('on_battery', 'idle')
+            return policy == 'run' or (policy == 'idle' and self._idleUntil > time.monotonic())
+        return True
+
+    def _jobCandidates(self, words):
+        """The wordlist, the rules pass (rules, rules_budget) and the masks, rebuilt when any of them changes."""
+        budget = self.options.get('rules_budget', 100000)
+        rules = self._rules() if budget else None
+        custom = self.options.get('mask_charsets') or []
+        masks = self.options.get('masks') or []
+        vendor = self.options.get('vendor_masks', True)
+        key = (words, rules and rules[0], budget, masks, custom, vendor)
+        if self._candidates is None or self._candidatesKey != key:
+            valid = []
+            for mask in masks:
+                try:
+                    valid.append(Mask(mask, custom).mask)
+                except ValueError as e:
+                    logging.error(f"[quickdic] Ignoring mask: {e}")
+            self._candidates = Candidates(words, rules, budget, valid, custom, vendor)
+            self._candidatesKey = key
+        return self._candidates
+
+    def _rules(self):
+        """The rules file's rules, the built-in ones while it can't be read."""
+        path = self.options.get('rules') or None
+        try:
+            rules = load_rules(path)
+        except OSError as e:
+            if self._rulesError != str(e):
+                logging.error(f"[quickdic] Could not read the rules, using the built-in ones: {e}")
+            self._rulesError = str(e)
+            return load_rules()
+        self._rulesError = None
+        return rules
+
+    def _jobWorker(self):
+        # runs the queued jobs one at a time while _mayRun allows, checkpointing every job where it
+        # stopped, and precomputes PMKs once the queue is empty
+        while not self._stop.is_set():
+            self._wake.wait(timeout=30)
+            self._wake.clear()
+            try:
+                self._runJobs()
+            except Exception as e:
+                # e.g. an unreadable wordlist folder, tried again on the next wake up
+                logging.error(f"[quickdic] Job worker: {e!r}")
+
+    def _runJobs(self):
+        if self._importFrom:
+            folder, self._importFrom = self._importFrom, None
+            added = self.potfile.import_cracked(folder, self.analysis)
+            if added:
+                logging.info(f"[quickdic] Imported {added} keys from .cracked files into the potfile")
+        while self._mayRun() and not self._stop.is_set():
+            words = self._wordlists()
+            candidates = self._jobCandidates(words)
+            job = self.jobs.next(candidates.version, self.options.get('job_budget', 600))
+            if job is None:
+                if self.pmks:
+                    self._fillPMKs(words)
+                break
+            try:
+                self._runJob(candidates, *job)
+            except Exception as e:
+                logging.error(f"[quickdic] Job for {job[0]} failed: {e}")
+                self.jobs.update(job[0], job[1], 'failed')
+
+    def _jobHashes(self, pcap, bssid, essid):
+        """Handshakes and PMKIDs of bssid in pcap, or None if there are none (any more)."""
+        try:
+            capture = self.analysis.capture(pcap)
+        except (OSError, PcapError):
+            return None
+        capture.learn_essid(bssid, essid)
+        return [target for target in targets(capture) if target.bssid == bssid] or None
+
+    def _runJob(self, candidates, pcap, bssid, essid, position, spent):
+        hashes = self._jobHashes(pcap, bssid, essid)
+        if not hashes:
+            self.jobs.update(pcap, bssid, 'gone')
+            return
+        name = essid.decode('utf-8', 'replace')
+
+        if self.engine == 'aircrack-ng':
+            pwd = self._aircrack(pcap, bssid)
+            self.jobs.update(pcap, bssid, 'cracked' if pwd else 'exhausted', candidates.version, len(candidates), spent)
+            if pwd:
+                self.potfile.add(bssid, essid, pwd.encode())
+                self._announce(self._accessPoint(pcap, bssid, essid), pwd)
+            return
+
+        # the PMK only depends on the word and the ESSID, so every queued job of this ESSID that is at
+        # the same word rides along: one PBKDF2 pass for all their handshakes and PMKIDs
+        group = {(pcap, bssid): (hashes, spent)}
+        for other, other_bssid, other_spent in self.jobs.siblings(essid, candidates.version, position):
+            other_hashes = self._jobHashes(other, other_bssid, essid)
+            if other_hashes:
+                group.setdefault((other, other_bssid), (other_hashes, other_spent))
+            else:
+                self.jobs.update(other, other_bssid, 'gone')
+        hashes = [target for job_hashes, _ in group.values() for target in job_hashes]
+
+        if self.pmks:
+            # the precomputed PMKs are a table scan of HMACs, and the dictionary run
+            # then only has to cover the words they don't
+            found = self.pmks.crack(essid, hashes)
+            if found:
+                self._finish(group, essid, candidates, position, 0, found[1], found[0], 'from the PMK database')
+                return
+            if position < len(candidates.wordlist):
+                position = max(position, self.pmks.position(essid, candidates.wordlist.version))
+
+        if position == 0:
+            # a handful of default keys derived from the MAC addresses, before the dictionary
+            guesses = [guess.encode() for _, member in group for guess in bssid_candidates(member)]
+            found = check_batch(essid, guesses, hashes)
+            if found:
+                self._finish(group, essid, candidates, position, 0, found[2], found[1], 'from the BSSID')
+                return
+
+        budget = self.options.get('job_budget', 600)
+        deadline = time.monotonic() + budget - spent if budget else None
+        pause = Event()
+
+        def progress(tested, seconds):
+            if self._stop.is_set() or not self._mayRun():
+                pause.set()
+
+        kinds = sorted({target.kind for target in hashes})
+        logging.info(f"[quickdic] Cracking {name} ({len(group)} jobs, {len(hashes)} {'+'.join(kinds)} hashes) "
+                     f"from word {position}/{candidates.total(essid)}")
+        workers = self.options.get('workers', 0) or os.cpu_count() or 1
+        # LAN workers take their share of the batches, without any the job runs locally as before
+        remotes = reachable(self.options.get('remote_workers') or [], self.options.get('remote_token', ''))
+        if remotes:
+            logging.info(f"[quickdic] Sharing {name} with {', '.join(worker.url for worker in remotes)}")
+        self._cracking = workers
+        try:
+            result = crack(essid, hashes, candidates.stream(essid, position), workers=workers, batch=self.options.get('batch', 128),
+                           deadline=deadline, stop=pause, progress=progress, niceness=self.options.get('nice', 10),
+                           remotes=remotes)
+        finally:
+            self._cracking = 0
+        if result.exhausted:
+            state = 'exhausted'
+        elif pause.is_set() or result.key:
+            state = 'queued'
         else:
-            logging.warning("aircrack-ng is not installed!")
+            state = 'budget'
+        logging.info(f"[quickdic] {name}: tested {result.position} keys in {result.seconds:.1f}s "
+                     f"({result.rate:.0f} keys/s), {'cracked' if result.key else state} at "
+                     f"{position + result.position}/{candidates.total(essid)}")
+        self._finish(group, essid, candidates, position + result.position, result.seconds, result.pmk, result.key, state=state)
+
+    def _finish(self, group, essid, candidates, position, seconds, key_pmk, key, how='', state='queued'):
+        # the jobs whose hashes the key cracks are done, the others carry on from position
+        for (pcap, bssid), (hashes, spent) in group.items():
+            if key is not None and any(target.check(key_pmk) for target in hashes):
+                self.jobs.update(pcap, bssid, 'cracked', candidates.version, position, spent + seconds)
+                self._announce(self._accessPoint(pcap, bssid, essid), self._cracked(pcap, bssid, essid, key, how))
+            else:
+                self.jobs.update(pcap, bssid, state, candidates.version, position, spent + seconds)
+
+    def _fillPMKs(self, words):
+        # precompute the PMKs of the most seen ESSIDs while the agent waits or the unit charges
+        plugged = power() == 'charging'
+        if not plugged and self._idleUntil <= time.monotonic():
+            return
+        version = words.version
+        configured = [essid.encode() for essid in self.options.get('pmk_essids', [])]
+        essids = [(essid, self.pmks.position(essid, version)) for essid in configured]
+        essids += [(essid, position) for essid, position in self.pmks.popular(self.options.get('pmk_max_essids', 10), version)
+                   if essid not in configured]
+        for essid, position in essids:
+            if position >= len(words):
+                continue
+            deadline = None if plugged else self._idleUntil
+            if self._stop.is_set() or (deadline is not None and deadline <= time.monotonic()) or self.jobs.pending():
+                break
+            start = time.monotonic()
+            added, exhausted = self.pmks.fill(essid, words.words(position), version, position,
+                                              workers=self.options.get('workers', 0) or os.cpu_count() or 1,
+                                              deadline=deadline, stop=self._wake, niceness=self.options.get('nice', 10))
+            if added:
+                logging.info(f"[quickdic] Precomputed {added} PMKs for {essid.decode('utf-8', 'replace')} "
+                             f"in {time.monotonic() - start:.0f}s")
 
     def on_handshake(self, agent, filename, access_point, client_station):
-        display = agent.view()
-        result = subprocess.run(('/usr/bin/aircrack-ng ' + filename + ' | grep "1 handshake" | awk \'{print $2}\''),
-                                shell=True, stdout=subprocess.PIPE)
-        result = result.stdout.decode('utf-8').translate({ord(c): None for c in string.whitespace})
-        if not result:
-            logging.info("[quickdic] No handshake")
-        else:
-            logging.info("[quickdic] Handshake confirmed")
-            result2 = subprocess.run(('aircrack-ng -w `echo ' + self.options[
-                'wordlist_folder'] + '*.txt | sed \'s/\ /,/g\'` -l ' + filename + '.cracked -q -b ' + result + ' ' + filename + ' | grep KEY'),
-                                     shell=True, stdout=subprocess.PIPE)
-            result2 = result2.stdout.decode('utf-8').strip()
-            logging.info(f"[quickdic] {result2}")
-            if result2 != "KEY NOT FOUND":
-                key = re.search('\[(.*)\]', result2)
-                pwd = str(key.group(1))
-                self.text_to_set = "Cracked password: " + pwd
-                display.update(force=True)
-                plugins.on('cracked', access_point, pwd)
+        # only queue the handshake, the job worker cracks it when load and power allow
+        self._agent = agent
+        try:
+            capture = self.analysis.capture(filename)
+        except (OSError, PcapError):
+            capture = None
+        if capture and access_point and access_point.get('hostname') not in (None, '', '<hidden>'):
+            capture.learn_essid(bytes.fromhex(access_point['mac'].replace(':', '')), access_point['hostname'].encode())
+        hashes = targets(capture) if capture else []
+        if not hashes:
+            logging.info("[quickdic] No handshake or PMKID")
+            return
+
+        logging.info(f"[quickdic] {' and '.join(sorted({'PMKID' if target.kind == 'pmkid' else 'Handshake' for target in hashes}))} confirmed")
+        if not self.jobs:
+            return
+        # a network cracked before is one PBKDF2 away, no need to queue it
+        for bssid, essid in self._tryKnown(filename, hashes, access_point):
+            self.jobs.add(filename, bssid, essid, [target.line() for target in hashes if target.bssid == bssid],
+                          access_point if self._isAP(access_point, bssid) else None)
+            if self.pmks:
+                self.pmks.see(essid)
+        self._wake.set()
+
+    @staticmethod
+    def _isAP(access_point, bssid):
+        return bool(access_point) and access_point.get('mac', '').replace(':', '').lower() == bssid.hex()
+
+    def _accessPoint(self, pcap, bssid, essid):
+        # bettercap's access_point for the cracked event, a minimal one for APs it didn't report
+        return (self.jobs.access_point(pcap, bssid)
+                or {'mac': ':'.join(f'{b:02x}' for b in bssid), 'hostname': essid.decode('utf-8', 'replace')})
+
+    def _announce(self, access_point, pwd):
+        self.text_to_set = "Cracked password: " + pwd
+        if self._agent:
+            self._agent.view().update(force=True)
+        plugins.on('cracked', access_point, pwd)
+
+    def _cracked(self, filename, bssid, essid, key, how=''):
+        pwd = key.decode('utf-8', 'replace')
+        logging.info(f"[quickdic] KEY FOUND! [ {pwd} ]{' ' + how if how else ''}")
+        with open(filename + '.cracked', 'w') as f:
+            f.write(pwd)
+        self.potfile.add(bssid, essid, key)
+        return pwd
+
+    def _tryKnown(self, filename, hashes, access_point=None):
+        """Test the potfile keys of every AP in hashes, one PBKDF2 each. Returns the APs that are
+        still to crack."""
+        left = set()
+        for bssid, essid in {(target.bssid, target.essid) for target in hashes}:
+            ap_hashes = [target for target in hashes if target.bssid == bssid]
+            for key in self.potfile.keys(bssid, essid):
+                if any(target.check(pmk(key, essid)) for target in ap_hashes):
+                    ap = access_point if self._isAP(access_point, bssid) else self._accessPoint(filename, bssid, essid)
+                    self._announce(ap, self._cracked(filename, bssid, essid, key, 'from the potfile'))
+                    break
+            else:
+                left.add((bssid, essid))
+        return left
+
+    def _aircrack(self, filename, bssid):
+        bssid = ':'.join(f'{b:02x}' for b in bssid)
+        wordlists = ','.join(sorted(glob.glob(os.path.join(self.options['wordlist_folder'], '*.txt'))))
+        result2 = subprocess.run(['aircrack-ng', '-w', wordlists, '-l', filename + '.cracked', '-q', '-b', bssid, filename],
+                                 stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        result2 = next((line.strip() for line in result2.stdout.decode('utf-8', 'replace').splitlines() if 'KEY' in line),
+                       "KEY NOT FOUND")
+        logging.info(f"[quickdic] {result2}")
+        if result2 != "KEY NOT FOUND":
+            key = re.search(r'\[ ?(.*?) ?\]', result2)
+            return str(key.group(1))
+        return None
 
     def on_ui_update(self, ui):
         if self.text_to_set:
@@ -0,0 +1,6 @@
+"""Helpers shared by the plugins in this folder, kept out of the plugin modules so
+pwnagotchi does not register a plugin twice when one of them imports another.
+
+The plugins load this package by path rather than putting the plugin folder on
+sys.path, where plugins named like their libraries (telegram.py, discord.py)
+would shadow them."""
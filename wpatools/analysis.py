@@ -0,0 +1,133 @@
+"""
+One parse per pcap version for every plugin in the process.
+
+hashie, aircrackonly and quickdic all get the same handshake event for the same
+pcap. They ask this cache instead of parsing it (or running aircrack-ng or
+hcxpcaptool on it) themselves. A capture is identified by its path, size and
+mtime; when bettercap appends to a pcap only the new records are parsed. The
+parser state is kept in SQLite as well, so it survives a reboot.
+"""
+from collections import OrderedDict
+import logging
+import os
+import sqlite3
+import struct
+import time
+from threading import Lock
+
+from wpatools.pcap import PARSER_VERSION, CaptureInfo, PcapError, scan_pcap
+
+ANALYSIS_DB = '/root/.pcap-analysis.db'
+
+
+class PcapAnalysis:
+    """CaptureInfo of the most recent pcaps in memory, of all of them in SQLite (if path is given).
+
+    Callers share the returned CaptureInfo, they may teach it ESSIDs but must not change anything else."""
+
+    def __init__(self, path=None, keep=32):
+        self.lock = Lock()
+        self.db = None
+        self.keep = keep
+        self.parses = 0
+        self._recent = OrderedDict()  # path -> ((size, mtime), CaptureInfo or None if unreadable)
+        self._committed = time.monotonic()
+        if path:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute('CREATE TABLE IF NOT EXISTS analyses (path TEXT PRIMARY KEY, size INTEGER, mtime REAL, '
+                            'parser INTEGER, crackable TEXT, bssids TEXT, state TEXT)')
+            self.db.commit()
+
+    def capture(self, path):
+        """Return the CaptureInfo of the current content of path, parsing at most what was appended
+        since the last call. Raises OSError or PcapError if the pcap can't be read."""
+        st = os.stat(path)
+        version = (st.st_size, st.st_mtime)
+        with self.lock:
+            cached = self._recent.get(path) or self._load(path)
+            if cached and cached[0] == version:
+                self._remember(path, cached)
+                info = cached[1]
+            else:
+                try:
+                    # resume into a copy, the cached capture may be in use by other threads
+                    info = scan_pcap(path, cached[1].copy() if cached and cached[1] else None)
+                except (ValueError, IndexError, struct.error, PcapError):
+                    info = None
+                self.parses += 1
+                self._remember(path, (version, info))
+                self._save(path, version, info)
+        if info is None:
+            raise PcapError(f'{path} could not be parsed')
+        return info
+
+    def crackable(self, path):
+        """'handshake', 'pmkid' or None, like CaptureInfo.crackable, None for unreadable pcaps too."""
+        try:
+            return self.capture(path).crackable()
+        except (OSError, PcapError):
+            return None
+
+    def prune(self, folder, paths):
+        """Forget the pcaps in folder that are not in paths any more."""
+        keep = set(paths)
+        with self.lock:
+            for path in [path for path in self._recent if os.path.dirname(path) == folder and path not in keep]:
+                del self._recent[path]
+            if self.db:
+                rows = self.db.execute('SELECT path FROM analyses WHERE path LIKE ?', (os.path.join(folder, '%'),))
+                gone = [(row[0],) for row in rows if os.path.dirname(row[0]) == folder and row[0] not in keep]
+                self.db.executemany('DELETE FROM analyses WHERE path = ?', gone)
+                self.db.commit()
+
+    def commit(self):
+        with self.lock:
+            if self.db:
+                self.db.commit()
+                self._committed = time.monotonic()
+
+    def _remember(self, path, entry):
+        self._recent[path] = entry
+        self._recent.move_to_end(path)
+        while len(self._recent) > self.keep:
+            self._recent.popitem(last=False)
+
+    def _load(self, path):
+        if not self.db:
+            return None
+        row = self.db.execute('SELECT size, mtime, state FROM analyses WHERE path = ? AND parser = ?',
+                              (path, PARSER_VERSION)).fetchone()
+        if not row:
+            return None
+        try:
+            return (row[0], row[1]), CaptureInfo.from_json(row[2]) if row[2] else None
+        except (ValueError, KeyError, TypeError):
+            return None
+
+    def _save(self, path, version, info):
+        if not self.db:
+            return
+        bssids = ','.join(sorted(bssid.hex() for bssid in info.bssids())) if info else ''
+        self.db.execute('INSERT OR REPLACE INTO analyses VALUES (?, ?, ?, ?, ?, ?, ?)',
+                        (path, version[0], version[1], PARSER_VERSION, info.crackable() or '' if info else None,
+                         bssids, info.to_json() if info else None))
+        # a batch run parses hundreds of pcaps, don't sync the sd card for every one of them
+        if time.monotonic() - self._committed > 10:
+            self.db.commit()
+            self._committed = time.monotonic()
+
+
+_shared = {}
+_shared_lock = Lock()
+
+
+def shared(path=ANALYSIS_DB):
+    """Return the PcapAnalysis every plugin of this process uses for path."""
+    with _shared_lock:
+        if path not in _shared:
+            try:
+                _shared[path] = PcapAnalysis(path)
+            except sqlite3.Error as e:
+                logging.warning(f'[wpatools] Could not open {path}, pcap analyses are kept in memory only: {e}')
+                _shared[path] = PcapAnalysis()
+        return _shared[path]
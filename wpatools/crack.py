@@ -0,0 +1,266 @@
+"""
+WPA/WPA2-PSK key recovery in pure python.
+
+Every candidate costs one 4096 round PBKDF2-HMAC-SHA1 (hashlib does that in C),
+checking the resulting PMK against a PMKID is one HMAC-SHA1 and against an
+EAPOL MIC three to five more. Candidates are tested in batches in a fork pool,
+batches are collected in order so the number of candidates tested is always a
+valid position to resume from.
+"""
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import hashlib
+import hmac
+import multiprocessing
+import os
+import queue
+import time
+
+PKE = b'Pairwise key expansion'
+
+
+def pmk(passphrase, essid):
+    return hashlib.pbkdf2_hmac('sha1', passphrase, essid, 4096, 32)
+
+
+def _prf512(key, label, data):
+    return b''.join(hmac.new(key, label + b'\x00' + data + bytes([i]), hashlib.sha1).digest() for i in range(4))[:64]
+
+
+class Target:
+    """One hash to crack: a PMKID, or the MIC of an M2 with the ANonce it was paired with."""
+
+    def __init__(self, kind, bssid, sta, essid, pmkid=None, keyver=None, mic=None, anonce=None, snonce=None, eapol=None,
+                 pair=0):
+        self.kind = kind  # 'pmkid' or 'eapol'
+        self.bssid = bssid
+        self.sta = sta
+        self.essid = essid
+        self.pmkid = pmkid
+        self.keyver = keyver
+        self.mic = mic
+        self.eapol = eapol
+        self.anonce = anonce
+        self.pair = pair
+        if kind == 'eapol':
+            self._pke = min(bssid, sta) + max(bssid, sta) + min(anonce, snonce) + max(anonce, snonce)
+        else:
+            self._name = b'PMK Name' + bssid + sta
+
+    def __repr__(self):
+        return f'<Target {self.kind} {self.bssid.hex()} {self.essid!r}>'
+
+    def line(self):
+        """The hashcat 22000 line of this hash."""
+        if self.kind == 'pmkid':
+            return f'WPA*01*{self.pmkid.hex()}*{self.bssid.hex()}*{self.sta.hex()}*{self.essid.hex()}***'
+        return (f'WPA*02*{self.mic.hex()}*{self.bssid.hex()}*{self.sta.hex()}*{self.essid.hex()}*'
+                f'{self.anonce.hex()}*{self.eapol.hex()}*{self.pair:02x}')
+
+    def check(self, key):
+        """True if key is the PMK of this hash."""
+        if self.kind == 'pmkid':
+            return hmac.new(key, self._name, hashlib.sha1).digest()[:16] == self.pmkid
+        kck = _prf512(key, PKE, self._pke)[:16]
+        digest = hashlib.md5 if self.keyver == 1 else hashlib.sha1
+        return hmac.new(kck, self.eapol, digest).digest()[:16] == self.mic
+
+
+def parse_line(line):
+    """The Target of a hashcat 22000 line, raises ValueError if it isn't one this engine can check."""
+    fields = line.strip().split('*')
+    if len(fields) != 9 or fields[0] != 'WPA' or fields[1] not in ('01', '02'):
+        raise ValueError(f'not a 22000 line: {line!r}')
+    value, bssid, sta, essid, anonce, eapol, pair = (bytes.fromhex(field) for field in fields[2:])
+    if fields[1] == '01':
+        return Target('pmkid', bssid, sta, essid, pmkid=value)
+    keyver = eapol[6] & 7 if len(eapol) >= 99 else 0
+    if keyver not in (1, 2):
+        raise ValueError(f'unsupported key version {keyver}')
+    return Target('eapol', bssid, sta, essid, keyver=keyver, mic=value, anonce=anonce, snonce=eapol[17:49],
+                  eapol=eapol, pair=pair[0] if pair else 0)
+
+
+def targets(capture, kinds=('eapol', 'pmkid')):
+    """Crackable Targets of a CaptureInfo whose ESSID is known, PMKIDs first as they are the
+    cheapest to check. Key version 3 (AES-CMAC, 802.11w networks) can't be checked without
+    a CMAC implementation and is left out."""
+    found = []
+    if 'pmkid' in kinds:
+        for (bssid, sta), pmkid in capture.pmkids.items():
+            essid = capture.essids.get(bssid)
+            if essid:
+                found.append(Target('pmkid', bssid, sta, essid, pmkid=pmkid))
+    if 'eapol' in kinds:
+        for bssid, sta, essid, pair, keyver, mic, anonce, snonce, eapol in capture.handshakes():
+            if keyver in (1, 2):
+                found.append(Target('eapol', bssid, sta, essid, keyver=keyver, mic=mic, anonce=anonce,
+                                    snonce=snonce, eapol=eapol, pair=pair))
+    return found
+
+
+def check_batch(essid, words, hashes):
+    """Return (index, word, pmk) of the first word in words that cracks one of hashes, or None."""
+    for index, word in enumerate(words):
+        key = pmk(word, essid)
+        for target in hashes:
+            if target.check(key):
+                return index, word, key
+    return None
+
+
+class CrackResult:
+    """Outcome of a crack() run: the key if one was found, and position, the number of candidates
+    tested without a gap (up to and including the key), to resume from for the hashes not cracked."""
+
+    def __init__(self):
+        self.key = None
+        self.pmk = None
+        self.cracked = []
+        self.position = 0
+        self.exhausted = False
+        self.seconds = 0.0
+
+    @property
+    def rate(self):
+        return self.position / self.seconds if self.seconds else 0.0
+
+
+def _crack_init(niceness):
+    os.nice(niceness)
+
+
+def crack(essid, hashes, candidates, workers=1, batch=128, deadline=None, stop=None, progress=None, niceness=10,
+          remotes=()):
+    """Test candidates (an iterable of bytes) against hashes, which must all share essid.
+
+    Stops at the first key, once the candidates run out, at deadline (time.monotonic())
+    or once the stop Event is set. progress(tested, seconds) is called after every batch.
+    remotes are wpatools.remote.Worker-like objects (slots, batch, check()) that take
+    batches alongside the local processes."""
+    result = CrackResult()
+    start = time.monotonic()
+    words = iter(candidates)
+
+    def batches():
+        while True:
+            chunk = []
+            for word in words:
+                chunk.append(word)
+                if len(chunk) == batch:
+                    break
+            if not chunk:
+                return
+            yield chunk
+
+    def done(chunk, found):
+        result.seconds = time.monotonic() - start
+        if found:
+            index, result.key, result.pmk = found
+            result.position += index + 1
+            result.cracked = [target for target in hashes if target.check(result.pmk)]
+        else:
+            result.position += len(chunk)
+        if progress:
+            progress(result.position, result.seconds)
+
+    def halted():
+        return (result.key is not None or (deadline is not None and time.monotonic() >= deadline)
+                or (stop is not None and stop.is_set()))
+
+    if remotes:
+        return _crack_shared(essid, hashes, words, max(1, workers), batch, remotes, niceness, result, done, halted)
+
+    if workers <= 1:
+        for chunk in batches():
+            if halted():
+                return result
+            done(chunk, check_batch(essid, chunk, hashes))
+        result.exhausted = result.key is None
+        return result
+
+    pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork'),
+                               initializer=_crack_init, initargs=(niceness,))
+    pending = deque()
+    try:
+        for chunk in batches():
+            if halted():
+                break
+            pending.append((chunk, pool.submit(check_batch, essid, chunk, hashes)))
+            if len(pending) >= workers * 2:
+                chunk, future = pending.popleft()
+                done(chunk, future.result())
+        else:
+            while pending and result.key is None:
+                chunk, future = pending.popleft()
+                done(chunk, future.result())
+            result.exhausted = result.key is None
+    finally:
+        for chunk, future in pending:
+            future.cancel()
+        pool.shutdown(wait=False)
+    return result
+
+
+def _crack_shared(essid, hashes, words, workers, batch, remotes, niceness, result, done, halted):
+    # every batch goes to whichever local process or remote slot is free next, sized for it, so
+    # the keyspace is split by speed; a remote that fails is dropped and its batch redone locally
+    pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork'),
+                               initializer=_crack_init, initargs=(niceness,))
+    slots = queue.Queue()
+    for _ in range(workers):
+        slots.put(None)
+    for remote in remotes:
+        for _ in range(remote.slots):
+            slots.put(remote)
+    total = workers + sum(remote.slots for remote in remotes)
+    threads = ThreadPoolExecutor(max_workers=total)
+    dropped = set()
+
+    def run(slot, chunk):
+        if slot is not None and slot not in dropped:
+            try:
+                found = slot.check(essid, hashes, chunk)
+                slots.put(slot)
+                return found
+            except OSError:
+                dropped.add(slot)
+        try:
+            return pool.submit(check_batch, essid, chunk, hashes).result()
+        finally:
+            if slot is None:
+                slots.put(slot)
+
+    def collect(block=False):
+        while pending and result.key is None and (block or pending[0][1].done()):
+            chunk, future = pending.popleft()
+            done(chunk, future.result())
+            block = False
+
+    pending = deque()
+    try:
+        while True:
+            collect()
+            if halted():
+                break
+            try:
+                slot = slots.get(timeout=1)
+            except queue.Empty:
+                continue
+            if slot in dropped:
+                continue
+            chunk = [word for _, word in zip(range(slot.batch if slot else batch), words)]
+            if not chunk:
+                while pending and result.key is None:
+                    collect(block=True)
+                result.exhausted = result.key is None
+                break
+            pending.append((chunk, threads.submit(run, slot, chunk)))
+            if len(pending) >= total * 2:
+                collect(block=True)
+    finally:
+        for chunk, future in pending:
+            future.cancel()
+        threads.shutdown(wait=False)
+        pool.shutdown(wait=False)
+    return result
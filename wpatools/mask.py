@@ -0,0 +1,141 @@
+"""
+Mask attack: every key of a fixed pattern, like the 8 digit default keys of many ISP routers.
+
+Masks use hashcat's syntax, ?d for a digit, ?l ?u lower and upper case letters, ?h ?H
+lower and upper case hex digits, ?s symbols, ?a all of those, ?1 to ?4 custom charsets
+and anything else for itself (?? is a question mark). Candidate n of a mask is n written
+in the mixed radix of its charsets, the last position counting fastest, so a mask
+position is a checkpoint like a wordlist position and resuming is arithmetic.
+
+Candidates are generated a block at a time into one bytes object: with numpy as a
+vectorised divmod over the block's indices, without it by stamping each prefix into a
+precomputed block of all suffixes with strided slice assignments. Either way there is
+no per-character python loop.
+"""
+import hashlib
+import itertools
+import math
+import re
+import string
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+CHARSETS = {
+    'l': string.ascii_lowercase,
+    'u': string.ascii_uppercase,
+    'd': string.digits,
+    'h': '0123456789abcdef',
+    'H': '0123456789ABCDEF',
+    's': ' !"#$%&\'()*+,-./:;<=>?@[\\]^_`{|}~',
+}
+CHARSETS['a'] = CHARSETS['l'] + CHARSETS['u'] + CHARSETS['d'] + CHARSETS['s']
+
+# default key formats of ISP routers, by ESSID: (ESSID pattern, mask, custom charsets)
+VENDOR_MASKS = [
+    (r'^TP-LINK_[0-9A-F]{4,6}$', '?d?d?d?d?d?d?d?d', ()),
+    (r'^SKY[0-9A-F]{5}$', '?u?u?u?u?u?u?u?u', ()),
+    (r'^BTHub[3-6]-[0-9A-Z]{4}$', '?h?h?h?h?h?h?h?h?h?h', ()),
+    (r'^TALKTALK-[0-9A-F]{6}$', '?1?1?1?1?1?1?1?1', ('34679ACDEFGHJKLMNPQRTUVWXY',)),
+    (r'^VM[0-9]{7}$', '?l?l?l?l?l?l?l?l', ()),
+    (r'^UPC[0-9]{6,7}$', '?u?u?u?u?u?u?u?u', ()),
+]
+VENDOR_VERSION = hashlib.sha1(repr(VENDOR_MASKS).encode()).hexdigest()[:8]
+
+BLOCK = 65536
+MAX_KEYSPACE = 2 ** 63
+
+
+def parse_mask(mask, custom=()):
+    """The list of charsets (bytes) of mask, raises ValueError for an unknown ?x."""
+    charsets = []
+    i = 0
+    while i < len(mask):
+        c = mask[i]
+        if c == '?' and i + 1 < len(mask):
+            key = mask[i + 1]
+            i += 2
+            if key == '?':
+                charsets.append(b'?')
+            elif key in CHARSETS:
+                charsets.append(CHARSETS[key].encode())
+            elif key in '1234' and int(key) <= len(custom):
+                charsets.append(bytes(dict.fromkeys(custom[int(key) - 1].encode())))
+            else:
+                raise ValueError(f'unknown charset ?{key} in {mask!r}')
+        else:
+            charsets.extend(bytes([b]) for b in c.encode())
+            i += 1
+    if not 8 <= len(charsets) <= 63:
+        raise ValueError(f'{mask!r} is not 8 to 63 characters long')
+    return charsets
+
+
+class Mask:
+    """The keyspace of one mask, count candidates (which can exceed sys.maxsize, so there is
+    no len()), words(start) yields them from the start-th on."""
+
+    def __init__(self, mask, custom=()):
+        self.mask = mask
+        self.charsets = parse_mask(mask, custom)
+        self.length = len(self.charsets)
+        self.count = math.prod(len(charset) for charset in self.charsets)
+        if self.count >= MAX_KEYSPACE:
+            # positions are stored as SQLite integers and numpy indices are int64
+            raise ValueError(f'{mask!r} has {self.count} keys, more than 2^63')
+        self.version = hashlib.sha1(repr((mask, self.charsets)).encode()).hexdigest()[:16]
+
+    def __repr__(self):
+        return f'<Mask {self.mask} ({self.count} keys)>'
+
+    def blocks(self, start=0):
+        """Yield bytes holding the candidates from the start-th on back to back, up to BLOCK at a time."""
+        if start >= self.count:
+            return
+        yield from (self._numpy_blocks if numpy is not None else self._bytes_blocks)(start)
+
+    def words(self, start=0):
+        size = self.length
+        for block in self.blocks(start):
+            for offset in range(0, len(block), size):
+                yield block[offset:offset + size]
+
+    def _numpy_blocks(self, start):
+        tables = [numpy.frombuffer(charset, dtype=numpy.uint8) for charset in self.charsets]
+        for first in range(start, self.count, BLOCK):
+            index = numpy.arange(first, min(first + BLOCK, self.count), dtype=numpy.int64)
+            out = numpy.empty((len(index), self.length), dtype=numpy.uint8)
+            for pos in range(self.length - 1, -1, -1):
+                index, digit = numpy.divmod(index, len(tables[pos]))
+                out[:, pos] = tables[pos][digit]
+            yield out.tobytes()
+
+    def _bytes_blocks(self, start):
+        # the longest suffix whose combinations fit in a block, every candidate of a block shares the prefix
+        split, suffixes = self.length, 1
+        while split > 0 and suffixes * len(self.charsets[split - 1]) <= BLOCK:
+            split -= 1
+            suffixes *= len(self.charsets[split])
+        size = self.length
+        template = bytearray(suffixes * size)
+        for pos in range(split, size):
+            # position pos repeats each of its characters (product of the later radices) times, cyclically
+            repeat = math.prod(len(charset) for charset in self.charsets[pos + 1:])
+            column = b''.join(bytes([c]) * repeat for c in self.charsets[pos])
+            template[pos::size] = column * (suffixes // len(column))
+        first, skip = divmod(start, suffixes)
+        for prefix in itertools.islice(itertools.product(*self.charsets[:split]), first, None):
+            for pos, c in enumerate(prefix):
+                template[pos::size] = bytes([c]) * suffixes
+            yield bytes(template[skip * size:])
+            skip = 0
+
+
+def masks_for(essid, masks=(), custom=(), vendor=True):
+    """The Masks to try for essid: the default key formats its name suggests (with vendor), then masks."""
+    name = essid.decode('utf-8', 'replace')
+    found = [Mask(mask, charsets) for pattern, mask, charsets in VENDOR_MASKS
+             if vendor and re.match(pattern, name, re.I)]
+    return found + [Mask(mask, custom) for mask in masks]
@@ -0,0 +1,484 @@
+"""
+802.11 capture parsing shared by the plugins.
+
+Reads pcap and pcapng files (radiotap, PPI, prism, AVS or raw 802.11) in a single
+pass through mmap and collects what converters and crackers need: ESSIDs from
+beacons, probe responses and association requests, the EAPOL-Key messages of
+4-way handshakes and PMKIDs.
+"""
+import hashlib
+import json
+import mmap
+import os
+import struct
+
+# pcap/pcapng containers and the link layers bettercap/hcxdumptool write
+PCAP_MAGIC = {
+    b'\xd4\xc3\xb2\xa1': '<', b'\xa1\xb2\xc3\xd4': '>',  # microsecond timestamps
+    b'\x4d\x3c\xb2\xa1': '<', b'\xa1\xb2\x3c\x4d': '>',  # nanosecond timestamps
+}
+PCAPNG_SHB = 0x0A0D0D0A
+LINKTYPE_IEEE802_11 = 105
+LINKTYPE_PRISM = 119
+LINKTYPE_RADIOTAP = 127
+LINKTYPE_AVS = 163
+LINKTYPE_PPI = 192
+LINKTYPES = (LINKTYPE_IEEE802_11, LINKTYPE_PRISM, LINKTYPE_RADIOTAP, LINKTYPE_AVS, LINKTYPE_PPI)
+
+LLC_EAPOL = b'\xaa\xaa\x03\x00\x00\x00\x88\x8e'
+PMKID_KDE = b'\x00\x0f\xac\x04'
+ZERO_NONCE = bytes(32)
+
+KEY_ACK = 0x0080
+KEY_MIC = 0x0100
+KEY_SECURE = 0x0200
+
+HCCAPX = struct.Struct('<4sIBB32sB16s6s32s6s32sH256s')
+MAX_PER_STATION = 8
+# seconds between an M2 and the M1/M3 it is paired with, hcxpcapngtool's default EAPOL timeout
+EAPOL_TIMEOUT = 5
+
+# bump whenever the python parser learns to extract more, so indexed failures are retried
+PARSER_VERSION = 2
+
+
+class PcapError(Exception):
+    pass
+
+
+def _valid_essid(essid):
+    return essid and essid.strip(b'\x00') and len(essid) <= 32
+
+
+class CaptureInfo:
+    """Beacons, EAPOL messages and PMKIDs collected from a capture in one pass.
+
+    offset is where the last complete record ended and link the container format,
+    byte order and linktypes needed to carry on from there when the pcap grows."""
+
+    def __init__(self):
+        self.essids = {}    # bssid -> essid
+        self.anonces = {}   # (bssid, sta) -> [(replay, msg, anonce, time)] from M1/M3
+        self.snonces = {}   # (bssid, sta) -> [(replay, keyver, mic, eapol, snonce, time)] from M2
+        self.pmkids = {}    # (bssid, sta) -> pmkid
+        self.frames = 0
+        self.offset = 0
+        self.link = None
+        self.head = b''
+        self.tail = b''
+
+    def checkpoint(self, buf):
+        # fingerprint of the header and the bytes before offset, to tell an append from a rewrite
+        self.head = bytes(buf[:24])
+        self.tail = hashlib.sha1(buf[max(self.offset - 64, 0):self.offset]).digest()
+
+    def resumable(self, buf):
+        return (self.link is not None and self.offset <= len(buf) and bytes(buf[:24]) == self.head
+                and hashlib.sha1(buf[max(self.offset - 64, 0):self.offset]).digest() == self.tail)
+
+    def to_json(self):
+        def pairs(table):
+            return [[bssid.hex(), sta.hex(), [[v.hex() if isinstance(v, bytes) else v for v in entry] for entry in entries]]
+                    for (bssid, sta), entries in table.items()]
+        return json.dumps({'essids': {bssid.hex(): essid.hex() for bssid, essid in self.essids.items()},
+                           'anonces': pairs(self.anonces), 'snonces': pairs(self.snonces),
+                           'pmkids': [[bssid.hex(), sta.hex(), pmkid.hex()] for (bssid, sta), pmkid in self.pmkids.items()],
+                           'frames': self.frames, 'offset': self.offset, 'link': self.link,
+                           'head': self.head.hex(), 'tail': self.tail.hex()})
+
+    @classmethod
+    def from_json(cls, data):
+        data = json.loads(data)
+        info = cls()
+        info.essids = {bytes.fromhex(bssid): bytes.fromhex(essid) for bssid, essid in data['essids'].items()}
+        info.anonces = {(bytes.fromhex(bssid), bytes.fromhex(sta)): [(replay, msg, bytes.fromhex(nonce), ts) for replay, msg, nonce, ts in entries]
+                        for bssid, sta, entries in data['anonces']}
+        info.snonces = {(bytes.fromhex(bssid), bytes.fromhex(sta)): [(replay, keyver, bytes.fromhex(mic), bytes.fromhex(eapol), bytes.fromhex(nonce), ts)
+                                                                     for replay, keyver, mic, eapol, nonce, ts in entries]
+                        for bssid, sta, entries in data['snonces']}
+        info.pmkids = {(bytes.fromhex(bssid), bytes.fromhex(sta)): bytes.fromhex(pmkid) for bssid, sta, pmkid in data['pmkids']}
+        info.frames = data['frames']
+        info.offset = data['offset']
+        info.link = data['link']
+        info.head = bytes.fromhex(data['head'])
+        info.tail = bytes.fromhex(data['tail'])
+        return info
+
+    def copy(self):
+        """An independent copy to parse more records into while this one is being read."""
+        info = CaptureInfo()
+        info.essids = dict(self.essids)
+        info.anonces = {key: list(entries) for key, entries in self.anonces.items()}
+        info.snonces = {key: list(entries) for key, entries in self.snonces.items()}
+        info.pmkids = dict(self.pmkids)
+        info.frames, info.offset, info.link, info.head, info.tail = self.frames, self.offset, self.link, self.head, self.tail
+        return info
+
+    def learn_essid(self, bssid, essid):
+        if _valid_essid(essid) and self.essids.get(bssid) != essid:
+            # copy on write: a capture handed out by PcapAnalysis is read by other threads
+            # while this runs, they keep iterating the dict they started with
+            self.essids = {**self.essids, bssid: essid}
+
+    def add_frame(self, buf, pos, end, ts=None):
+        # 802.11 header, see IEEE 802.11-2016 9.2.4
+        if end - pos < 24:
+            return
+        self.frames += 1
+        fc = buf[pos]
+        flags = buf[pos + 1]
+        ftype = (fc >> 2) & 3
+        subtype = fc >> 4
+        if ftype == 0:
+            if subtype in (5, 8):  # probe response, beacon
+                ies = pos + 36
+            elif subtype == 0:  # association request
+                ies = pos + 28
+            elif subtype == 2:  # reassociation request
+                ies = pos + 34
+            else:
+                return
+            if ies + 2 <= end and buf[ies] == 0:
+                essid_len = buf[ies + 1]
+                essid = buf[ies + 2:ies + 2 + essid_len]
+                if ies + 2 + essid_len <= end and _valid_essid(essid):
+                    # parsing happens on a capture nobody else holds yet, no need to copy
+                    self.essids[buf[pos + 16:pos + 22]] = essid
+        elif ftype == 2:
+            llc = _eapol_offset(buf, pos)
+            if llc is None:
+                return
+            direction = flags & 3
+            if direction == 1:  # to DS
+                bssid, sta = buf[pos + 4:pos + 10], buf[pos + 10:pos + 16]
+            elif direction == 2:  # from DS
+                bssid, sta = buf[pos + 10:pos + 16], buf[pos + 4:pos + 10]
+            else:
+                bssid = buf[pos + 16:pos + 22]
+                sta = buf[pos + 4:pos + 10] if buf[pos + 10:pos + 16] == bssid else buf[pos + 10:pos + 16]
+            self.add_eapol(bssid, sta, buf[llc + 8:end], ts)
+
+    def add_eapol(self, bssid, sta, eapol, ts=None):
+        # EAPOL-Key frame, see IEEE 802.11-2016 12.7.2
+        if len(eapol) < 99 or eapol[1] != 3 or eapol[4] not in (2, 254):
+            return
+        total = struct.unpack_from('>H', eapol, 2)[0] + 4
+        if total < 99 or total > len(eapol):
+            return
+        eapol = eapol[:total]
+        key_info = struct.unpack_from('>H', eapol, 5)[0]
+        keyver = key_info & 7
+        if keyver not in (1, 2, 3):
+            return
+        replay = struct.unpack_from('>Q', eapol, 9)[0]
+        nonce = eapol[17:49]
+        key = (bssid, sta)
+        if key_info & KEY_ACK:
+            msg = 3 if key_info & KEY_MIC else 1
+            if msg == 1:
+                self._find_pmkid(key, eapol)
+            self._remember(self.anonces, key, (replay, msg, nonce, ts))
+        elif key_info & KEY_MIC and not key_info & KEY_SECURE and nonce != ZERO_NONCE:
+            zeroed = eapol[:81] + bytes(16) + eapol[97:]
+            self._remember(self.snonces, key, (replay, keyver, eapol[81:97], zeroed, nonce, ts))
+
+    def _find_pmkid(self, key, eapol):
+        data_len = struct.unpack_from('>H', eapol, 97)[0]
+        data = eapol[99:99 + data_len]
+        i = 0
+        while i + 2 <= len(data):
+            tag, length = data[i], data[i + 1]
+            if tag == 0xdd and length >= 20 and data[i + 2:i + 6] == PMKID_KDE:
+                pmkid = data[i + 6:i + 22]
+                if pmkid != bytes(16):
+                    self.pmkids[key] = pmkid
+                return
+            i += 2 + length
+
+    def wanted(self):
+        """BSSIDs with a PMKID or M2 but no ESSID in this capture."""
+        return {bssid for bssid, sta in list(self.pmkids) + list(self.snonces) if bssid not in self.essids}
+
+    @classmethod
+    def merged(cls, captures):
+        """Combine several captures into one, as if their frames had been captured in a single pcap.
+        Their messages are only paired when captured within EAPOL_TIMEOUT of each other, like in one pcap."""
+        info = cls()
+        for capture in captures:
+            info.essids.update(capture.essids)
+            info.pmkids.update(capture.pmkids)
+            info.frames += capture.frames
+            for table, entries in ((info.anonces, capture.anonces), (info.snonces, capture.snonces)):
+                for key, values in entries.items():
+                    for value in values:
+                        cls._remember(table, key, value)
+        return info
+
+    def bssids(self):
+        """BSSIDs this capture has EAPOL messages or PMKIDs for."""
+        return {bssid for bssid, sta in list(self.anonces) + list(self.snonces) + list(self.pmkids)}
+
+    def messages(self, bssid):
+        """The PMKIDs, MICs and ANonces this capture has of bssid, the parts a hash is made of."""
+        parts = {pmkid for (ap, sta), pmkid in self.pmkids.items() if ap == bssid}
+        parts.update(entry[2] for (ap, sta), entries in self.snonces.items() if ap == bssid for entry in entries)
+        parts.update(entry[2] for (ap, sta), entries in self.anonces.items() if ap == bssid for entry in entries)
+        return parts
+
+    @staticmethod
+    def _remember(table, key, entry):
+        # a retransmission only differs in its time, the first one is kept
+        entries = table.setdefault(key, [])
+        if all(other[:-1] != entry[:-1] for other in entries):
+            entries.append(entry)
+            del entries[:-MAX_PER_STATION]
+
+    def pairs(self):
+        """Yield (bssid, sta, message_pair, keyver, mic, anonce, snonce, eapol) for every M2 that can be
+        paired with an ANonce from M1 (pair 0) or M3 (pair 2) captured within EAPOL_TIMEOUT of it,
+        whether or not the ESSID is known."""
+        seen = set()
+        for key, m2s in self.snonces.items():
+            anonces = self.anonces.get(key, [])
+            for replay, keyver, mic, eapol, snonce, ts in m2s:
+                for a_replay, msg, anonce, a_ts in anonces:
+                    if ts is not None and a_ts is not None and abs(ts - a_ts) > EAPOL_TIMEOUT:
+                        continue  # the same replay counter in another association
+                    if (msg == 1 and a_replay == replay) or (msg == 3 and a_replay == replay + 1):
+                        if (mic, anonce) not in seen:
+                            seen.add((mic, anonce))
+                            yield key[0], key[1], 0 if msg == 1 else 2, keyver, mic, anonce, snonce, eapol
+
+    def handshakes(self):
+        """Yield (bssid, sta, essid, message_pair, keyver, mic, anonce, snonce, eapol) for every
+        pair whose ESSID is known."""
+        for bssid, sta, pair, keyver, mic, anonce, snonce, eapol in self.pairs():
+            essid = self.essids.get(bssid)
+            if essid is not None:
+                yield bssid, sta, essid, pair, keyver, mic, anonce, snonce, eapol
+
+    def crackable(self):
+        """'handshake' if a message pair was captured, else 'pmkid' if a PMKID was, else None."""
+        if next(self.pairs(), None) is not None:
+            return 'handshake'
+        if self.pmkids:
+            return 'pmkid'
+        return None
+
+    def entries(self):
+        """Yield (bssid, sta, hash, 22000 line, legacy extension, legacy record) for every hash,
+        where hash is the PMKID or MIC and the legacy record is a 16800 line or an hccapx struct."""
+        for (bssid, sta), pmkid in self.pmkids.items():
+            essid = self.essids.get(bssid)
+            if essid:
+                yield (bssid, sta, pmkid, f'WPA*01*{pmkid.hex()}*{bssid.hex()}*{sta.hex()}*{essid.hex()}***',
+                       '16800', f'{pmkid.hex()}:{bssid.hex()}:{sta.hex()}:{essid.hex()}\n'.encode())
+        for bssid, sta, essid, pair, keyver, mic, anonce, snonce, eapol in self.handshakes():
+            if len(eapol) > 256:
+                continue
+            yield (bssid, sta, mic, f'WPA*02*{mic.hex()}*{bssid.hex()}*{sta.hex()}*{essid.hex()}*'
+                                    f'{anonce.hex()}*{eapol.hex()}*{pair:02x}',
+                   '2500', HCCAPX.pack(b'HCPX', 4, pair, len(essid), essid, keyver, mic,
+                                       bssid, anonce, sta, snonce, len(eapol), eapol))
+
+    def hccapx(self):
+        return b''.join(entry[5] for entry in self.entries() if entry[4] == '2500')
+
+    def pmkid_lines(self):
+        return [entry[5].decode().strip() for entry in self.entries() if entry[4] == '16800']
+
+    def lines_22000(self):
+        return [entry[3] for entry in self.entries()]
+
+
+def _eapol_offset(buf, pos):
+    """Return where the LLC header of an unprotected EAPOL data frame starts, or None."""
+    flags = buf[pos + 1]
+    if flags & 0x40:
+        return None
+    hdr = 24
+    if flags & 3 == 3:
+        hdr += 6
+    if buf[pos] & 0x80:  # QoS data
+        hdr += 2
+        if flags & 0x80:
+            hdr += 4
+    llc = pos + hdr
+    return llc if buf[llc:llc + 8] == LLC_EAPOL else None
+
+
+def _link_offset(buf, linktype, pos, end):
+    """Return the (start, end) of the 802.11 frame inside a link layer record, or None to skip it."""
+    if end - pos < 8:
+        return None
+    if linktype == LINKTYPE_RADIOTAP:
+        rt_len = struct.unpack_from('<H', buf, pos + 2)[0]
+        if rt_len < 8 or pos + rt_len > end:
+            return None
+        present = struct.unpack_from('<I', buf, pos + 4)[0]
+        field = pos + 8
+        word = present
+        while word & 0x80000000 and field + 4 <= end:
+            word = struct.unpack_from('<I', buf, field)[0]
+            field += 4
+        if present & 0x02:
+            if present & 0x01:
+                field = pos + ((field - pos + 7) & ~7) + 8
+            if field < pos + rt_len:
+                rt_flags = buf[field]
+                if rt_flags & 0x40:  # bad FCS
+                    return None
+                if rt_flags & 0x10:  # FCS at end
+                    end -= 4
+        return pos + rt_len, end
+    if linktype == LINKTYPE_IEEE802_11:
+        return pos, end
+    if linktype == LINKTYPE_PPI:
+        start = pos + struct.unpack_from('<H', buf, pos + 2)[0]
+    elif linktype == LINKTYPE_PRISM:
+        start = pos + struct.unpack_from('<I', buf, pos + 4)[0]
+    elif linktype == LINKTYPE_AVS:
+        start = pos + struct.unpack_from('>I', buf, pos + 4)[0]
+    else:
+        return None
+    return (start, end) if start <= end else None
+
+
+def scan_buffer(buf, info):
+    """Feed every 802.11 frame of a pcap or pcapng buffer into a CaptureInfo, starting at
+    info.offset if info has already seen the beginning of this buffer.
+    Truncated trailing records (capture still being written) are left for the next call."""
+    size = len(buf)
+    if info.link is None:
+        if size < 24:
+            raise PcapError('file too short')
+        magic = bytes(buf[:4])
+        if magic in PCAP_MAGIC:
+            endian = PCAP_MAGIC[magic]
+            linktype = struct.unpack_from(endian + 'I', buf, 20)[0] & 0xffff
+            if linktype not in LINKTYPES:
+                raise PcapError(f'unsupported linktype {linktype}')
+            info.link = ['pcap', endian, [linktype]]
+            info.offset = 24
+        elif struct.unpack_from('<I', buf, 0)[0] == PCAPNG_SHB:
+            info.link = ['pcapng', '<', []]
+            info.offset = 0
+        else:
+            raise PcapError('not a pcap or pcapng file')
+    container, endian, linktypes = info.link
+    pos = info.offset
+    if container == 'pcap':
+        linktype = linktypes[0]
+        record = struct.Struct(endian + 'IIII')
+        fraction = 1e9 if bytes(buf[:4]) in (b'\x4d\x3c\xb2\xa1', b'\xa1\xb2\x3c\x4d') else 1e6
+        while pos + 16 <= size:
+            seconds, part, caplen, _ = record.unpack_from(buf, pos)
+            start = pos + 16
+            if start + caplen > size:
+                break
+            pos = start + caplen
+            frame = _link_offset(buf, linktype, start, pos)
+            if frame:
+                info.add_frame(buf, *frame, seconds + part / fraction)
+    else:
+        while pos + 12 <= size:
+            block_type, block_len = struct.unpack_from(endian + 'II', buf, pos)
+            if block_type == PCAPNG_SHB:
+                endian = '<' if struct.unpack_from('<I', buf, pos + 8)[0] == 0x1A2B3C4D else '>'
+                block_len = struct.unpack_from(endian + 'I', buf, pos + 4)[0]
+                linktypes = []
+            if block_len < 12 or pos + block_len > size:
+                break
+            if block_type == 1:  # interface description
+                linktypes.append(struct.unpack_from(endian + 'H', buf, pos + 8)[0])
+            elif block_type == 6:  # enhanced packet
+                iface, high, low, caplen = struct.unpack_from(endian + 'IIII', buf, pos + 8)
+                start = pos + 28
+                if iface < len(linktypes) and linktypes[iface] in LINKTYPES:
+                    frame = _link_offset(buf, linktypes[iface], start, min(start + caplen, pos + block_len - 4))
+                    if frame:
+                        # microseconds, the if_tsresol default every capture tool we read keeps
+                        info.add_frame(buf, *frame, ((high << 32) | low) / 1e6)
+            elif block_type == 3 and linktypes and linktypes[0] in LINKTYPES:  # simple packet
+                frame = _link_offset(buf, linktypes[0], pos + 12, pos + block_len - 4)
+                if frame:
+                    info.add_frame(buf, *frame)
+            pos += block_len
+        info.link = [container, endian, linktypes]
+    info.offset = pos
+    info.checkpoint(buf)
+    return info
+
+
+def scan_pcap(path, info=None):
+    """Parse a capture file through a memory map and return its CaptureInfo.
+    If info is the state of an earlier scan of the same, since grown, file only the new records are read."""
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size < 24:
+            raise PcapError('file too short')
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            if info is None or not info.resumable(buf):
+                info = CaptureInfo()
+            scan_buffer(buf, info)
+    return info
+
+
+def _compact_keep(buf, pos, end, seen):
+    # beacons and probe responses are only kept once per BSSID and ESSID
+    if end - pos < 24:
+        return False
+    ftype = (buf[pos] >> 2) & 3
+    subtype = buf[pos] >> 4
+    if ftype == 0:
+        if subtype in (5, 8):
+            ies = pos + 36
+            key = bytes(buf[pos + 16:pos + 22]) + bytes(buf[ies:ies + 2 + (buf[ies + 1] if ies + 2 <= end else 0)])
+            if key in seen:
+                return False
+            seen.add(key)
+            return True
+        return subtype in (0, 1, 2, 3)  # (re)association request/response
+    return ftype == 2 and _eapol_offset(buf, pos) is not None
+
+
+def compact_pcap(path):
+    """Rewrite a pcap in place with only the frames converters use: beacons and probe responses
+    (once per BSSID and ESSID), (re)association frames and EAPOL. The rewrite is atomic and keeps
+    the original timestamps. Returns (size before, size after), or None if nothing was dropped."""
+    with open(path, 'rb') as f:
+        st = os.fstat(f.fileno())
+        if st.st_size < 24:
+            return None
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            magic = bytes(buf[:4])
+            if magic not in PCAP_MAGIC:
+                return None
+            endian = PCAP_MAGIC[magic]
+            linktype = struct.unpack_from(endian + 'I', buf, 20)[0] & 0xffff
+            if linktype not in LINKTYPES:
+                return None
+            record = struct.Struct(endian + 'IIII')
+            kept = [buf[:24]]
+            seen = set()
+            pos = 24
+            while pos + 16 <= st.st_size:
+                start = pos + 16
+                end = start + record.unpack_from(buf, pos)[2]
+                if end > st.st_size:
+                    break
+                frame = _link_offset(buf, linktype, start, end)
+                if frame and _compact_keep(buf, *frame, seen):
+                    kept.append(buf[pos:end])
+                pos = end
+            kept.append(buf[pos:])
+    after = sum(len(chunk) for chunk in kept)
+    if after >= st.st_size:
+        return None
+    tmp = f'{path}.compact'
+    with open(tmp, 'wb') as f:
+        f.write(b''.join(kept))
+        f.flush()
+        os.fsync(f.fileno())
+    os.utime(tmp, ns=(st.st_atime_ns, st.st_mtime_ns))
+    os.replace(tmp, path)
+    return st.st_size, after
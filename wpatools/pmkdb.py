@@ -0,0 +1,133 @@
+"""
+Precomputed PMKs for the ESSIDs that keep coming back, like airolib-ng does.
+
+The PMK only depends on the passphrase and the ESSID, so once the wordlist has
+been run through PBKDF2 for "NETGEAR" every NETGEAR handshake is cracked by a
+table scan of HMACs. Each ESSID remembers which wordlist it was filled from and
+how far, filling resumes there and starts over when the wordlist changes.
+"""
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import sqlite3
+import time
+from threading import Lock
+
+from wpatools.crack import _crack_init, pmk
+
+PAGE = 4096
+
+
+def _derive(essid, words):
+    return [(word, pmk(word, essid)) for word in words]
+
+
+class PMKStore:
+    """SQLite table of (ESSID, passphrase) -> PMK, and how often each ESSID was seen."""
+
+    def __init__(self, path):
+        self.lock = Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS essids (essid BLOB PRIMARY KEY, seen INTEGER, last REAL, '
+                        'wordlist TEXT, position INTEGER)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS pmks (essid BLOB, word BLOB, pmk BLOB, '
+                        'PRIMARY KEY (essid, word)) WITHOUT ROWID')
+        self.db.commit()
+
+    def see(self, essid):
+        """Count a handshake for essid, the most seen ESSIDs are filled first."""
+        with self.lock:
+            self.db.execute('INSERT INTO essids VALUES (?, 1, ?, NULL, 0) '
+                            'ON CONFLICT(essid) DO UPDATE SET seen = seen + 1, last = excluded.last',
+                            (essid, time.time()))
+            self.db.commit()
+
+    def popular(self, limit, wordlist):
+        """The limit most seen ESSIDs with their fill position in wordlist (0 if filled from another one)."""
+        with self.lock:
+            rows = self.db.execute('SELECT essid, wordlist, position FROM essids ORDER BY seen DESC, last DESC LIMIT ?',
+                                   (limit,)).fetchall()
+        return [(bytes(essid), position if filled == wordlist else 0) for essid, filled, position in rows]
+
+    def position(self, essid, wordlist):
+        """How many candidates of wordlist have a PMK stored for essid."""
+        with self.lock:
+            row = self.db.execute('SELECT position FROM essids WHERE essid = ? AND wordlist = ?', (essid, wordlist)).fetchone()
+        return row[0] if row else 0
+
+    def crack(self, essid, hashes):
+        """Return (word, pmk) of the stored PMK that cracks one of hashes, or None."""
+        # a page at a time along the primary key, an ESSID filled from a big wordlist doesn't fit in memory
+        last = b''
+        while True:
+            with self.lock:
+                rows = self.db.execute('SELECT word, pmk FROM pmks WHERE essid = ? AND word > ? ORDER BY word LIMIT ?',
+                                       (essid, last, PAGE)).fetchall()
+            for word, key in rows:
+                key = bytes(key)
+                if any(target.check(key) for target in hashes):
+                    return bytes(word), key
+            if len(rows) < PAGE:
+                return None
+            last = rows[-1][0]
+
+    def add(self, essid, pairs, wordlist=None, position=None):
+        with self.lock:
+            self.db.executemany('INSERT OR IGNORE INTO pmks VALUES (?, ?, ?)', ((essid, word, key) for word, key in pairs))
+            if wordlist is not None:
+                self.db.execute('INSERT INTO essids VALUES (?, 0, ?, ?, ?) ON CONFLICT(essid) DO UPDATE SET '
+                                'wordlist = excluded.wordlist, position = excluded.position',
+                                (essid, time.time(), wordlist, position))
+            self.db.commit()
+
+    def fill(self, essid, candidates, wordlist, start=0, workers=1, batch=256, deadline=None, stop=None, niceness=10):
+        """Derive and store the PMKs of candidates (positioned at start of wordlist) for essid until they
+        run out, deadline passes or stop is set. Returns the number of PMKs added and whether
+        the candidates ran out."""
+        if start == 0:
+            with self.lock:
+                self.db.execute('DELETE FROM pmks WHERE essid = ?', (essid,))
+        words = iter(candidates)
+        position = start
+        added = 0
+        exhausted = False
+
+        def halted():
+            return (deadline is not None and time.monotonic() >= deadline) or (stop is not None and stop.is_set())
+
+        def chunks():
+            nonlocal exhausted
+            while not halted():
+                chunk = [word for _, word in zip(range(batch), words)]
+                if not chunk:
+                    exhausted = True
+                    return
+                yield chunk
+
+        def store(chunk, pairs):
+            nonlocal position, added
+            position += len(chunk)
+            added += len(pairs)
+            self.add(essid, pairs, wordlist, position)
+
+        if workers <= 1:
+            for chunk in chunks():
+                store(chunk, _derive(essid, chunk))
+            return added, exhausted
+        pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork'),
+                                   initializer=_crack_init, initargs=(niceness,))
+        pending = deque()
+        try:
+            for chunk in chunks():
+                pending.append((chunk, pool.submit(_derive, essid, chunk)))
+                if len(pending) >= workers * 2:
+                    chunk, future = pending.popleft()
+                    store(chunk, future.result())
+            while pending and not halted():
+                chunk, future = pending.popleft()
+                store(chunk, future.result())
+        finally:
+            for chunk, future in pending:
+                future.cancel()
+            pool.shutdown(wait=False)
+        return added, exhausted and not pending
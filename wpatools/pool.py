@@ -0,0 +1,57 @@
+"""
+Entry points for the plugins' fork pools.
+
+pwnagotchi loads a plugin from its file without registering it in sys.modules, so
+nothing defined in a plugin module can be pickled into a pool worker: the worker
+would have to import the plugin by name. The plugins bind() their instance here
+before the pool forks and submit call() with the name of the method to run, which
+pickles as a reference to this module.
+"""
+import os
+import shutil
+import signal
+import subprocess
+
+# the plugin instance the forked workers run methods of
+_target = None
+
+
+class JobTimeout(Exception):
+    """Raised by SIGALRM in a job that ran out of time. Not an OSError, so the except
+    OSError clauses around file access inside the job let it through."""
+
+
+def bind(target):
+    """Make target the instance the workers of the next pool forked call methods on."""
+    global _target
+    _target = target
+
+
+def init(niceness, ionice_class=None, setup=None):
+    """Pool initializer: run target.setup() (if given, e.g. to drop a sqlite connection that
+    belongs to the parent), then lower the worker's CPU and optionally IO priority."""
+    if setup:
+        getattr(_target, setup)()
+    os.nice(niceness)
+    if ionice_class is not None and shutil.which('ionice'):
+        subprocess.run(['ionice', '-c', str(ionice_class), '-p', str(os.getpid())],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def _alarm(signum, frame):
+    raise JobTimeout()
+
+
+def call(method, *args, timeout=0):
+    """Run target.method(*args) in a worker. With timeout, SIGALRM bounds it to that many
+    seconds and None is returned if it takes longer."""
+    if not timeout:
+        return getattr(_target, method)(*args)
+    signal.signal(signal.SIGALRM, _alarm)
+    signal.alarm(timeout)
+    try:
+        return getattr(_target, method)(*args)
+    except JobTimeout:
+        return None
+    finally:
+        signal.alarm(0)
@@ -0,0 +1,172 @@
+"""
+Cracking on other machines of the LAN.
+
+A worker daemon takes batches over HTTP: POST /crack with a JSON body of the ESSID,
+the hashcat 22000 lines of the hashes and the candidates (all hex), and answers with
+the index, word and PMK of the first candidate that cracks one of them, or null.
+GET /status tells how many batches of how many words it wants at a time. The words
+themselves are sent rather than wordlist positions, so a worker needs nothing but
+this module and can serve any number of pwnagotchis.
+
+Running this module is the stand-in worker, which cracks with hashlib like the
+local engine does:
+
+    python3 -m wpatools.remote --port 8765 --workers 4
+"""
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import argparse
+import http.client
+import json
+import logging
+import multiprocessing
+import os
+import urllib.error
+import urllib.request
+
+from wpatools.crack import check_batch, parse_line
+
+PROTOCOL = 1
+
+
+class Worker:
+    """A worker daemon at url. check() raises OSError when it can't be reached or fails."""
+
+    def __init__(self, url, token='', timeout=60):
+        self.url = url.rstrip('/')
+        self.token = token
+        self.timeout = timeout
+        self.slots = 2
+        self.batch = 1024
+
+    def __repr__(self):
+        return f'<Worker {self.url}>'
+
+    def _request(self, path, body=None, timeout=None):
+        data = json.dumps(body).encode() if body is not None else None
+        request = urllib.request.Request(self.url + path, data=data, headers={'Content-Type': 'application/json',
+                                                                              'X-Token': self.token})
+        try:
+            with urllib.request.urlopen(request, timeout=timeout or self.timeout) as response:
+                return json.loads(response.read())
+        except (ValueError, urllib.error.HTTPError, http.client.HTTPException) as e:
+            # a worker dying mid-answer raises IncompleteRead or BadStatusLine, which are no OSError
+            raise OSError(f'{self.url}{path}: {e!r}') from e
+
+    def status(self, timeout=3):
+        """Ask the worker how it wants to be fed, returns True if it speaks this protocol."""
+        status = self._request('/status', timeout=timeout)
+        if status.get('protocol') != PROTOCOL:
+            return False
+        self.slots = max(1, int(status.get('slots', self.slots)))
+        self.batch = max(1, int(status.get('batch', self.batch)))
+        return True
+
+    def check(self, essid, hashes, words):
+        """Remote check_batch(): (index, word, pmk) of the first of words that cracks one of hashes, or None."""
+        found = self._request('/crack', {'essid': essid.hex(), 'hashes': [target.line() for target in hashes],
+                                         'words': [bytes(word).hex() for word in words]})
+        if found is None:
+            return None
+        try:
+            return found['index'], bytes.fromhex(found['word']), bytes.fromhex(found['pmk'])
+        except (KeyError, TypeError, ValueError) as e:
+            raise OSError(f'{self.url}/crack: bad answer {found!r}') from e
+
+
+def reachable(urls, token='', timeout=3):
+    """The Workers of urls that answer, in order."""
+    workers = []
+    for url in urls:
+        worker = Worker(url, token)
+        try:
+            if worker.status(timeout):
+                workers.append(worker)
+        except OSError as e:
+            logging.debug(f'[remote] {url} unreachable: {e}')
+    return workers
+
+
+def _split_check(pool, workers, essid, hashes, words):
+    # one slice per process, the lowest index wins as the caller counts positions in order
+    size = -(-len(words) // workers)
+    futures = [(start, pool.submit(check_batch, essid, words[start:start + size], hashes))
+               for start in range(0, len(words), size)]
+    for start, future in futures:
+        found = future.result()
+        if found:
+            for _, other in futures:
+                other.cancel()
+            return start + found[0], found[1], found[2]
+    return None
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server_version = f'wpatools-worker/{PROTOCOL}'
+
+    def _reply(self, code, body):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _allowed(self):
+        if self.server.token and self.headers.get('X-Token') != self.server.token:
+            self._reply(403, {'error': 'bad token'})
+            return False
+        return True
+
+    def do_GET(self):
+        if not self._allowed():
+            return
+        if self.path != '/status':
+            return self._reply(404, {'error': 'not found'})
+        self._reply(200, {'protocol': PROTOCOL, 'slots': 2, 'batch': self.server.batch})
+
+    def do_POST(self):
+        if not self._allowed():
+            return
+        if self.path != '/crack':
+            return self._reply(404, {'error': 'not found'})
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            essid = bytes.fromhex(body['essid'])
+            hashes = [parse_line(line) for line in body['hashes']]
+            words = [bytes.fromhex(word) for word in body['words']]
+        except (KeyError, TypeError, ValueError) as e:
+            return self._reply(400, {'error': str(e)})
+        found = _split_check(self.server.pool, self.server.workers, essid, hashes, words) if words else None
+        self._reply(200, found and {'index': found[0], 'word': found[1].hex(), 'pmk': found[2].hex()})
+
+    def log_message(self, format, *args):
+        logging.debug(f'[remote] {self.address_string()} {format % args}')
+
+
+def serve(host='0.0.0.0', port=8765, workers=0, batch=0, token=''):
+    """Run the stand-in worker until interrupted."""
+    workers = workers or os.cpu_count() or 1
+    server = ThreadingHTTPServer((host, port), _Handler)
+    server.workers = workers
+    server.batch = batch or 512 * workers
+    server.token = token
+    server.pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork'))
+    logging.info(f'[remote] worker on {host}:{server.server_address[1]} with {workers} processes')
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        server.pool.shutdown(wait=False)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='wpatools cracking worker')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--workers', type=int, default=0, help='processes, 0 for one per core')
+    parser.add_argument('--batch', type=int, default=0, help='words per request, 0 for 512 per process')
+    parser.add_argument('--token', default='', help='shared secret the clients must send')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    serve(args.host, args.port, args.workers, args.batch, args.token)
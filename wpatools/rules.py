@@ -0,0 +1,269 @@
+"""
+Candidates beyond the wordlist: hashcat-style mangling rules and guesses derived
+from the ESSID and BSSID, generated lazily so nothing is written to the SD card.
+
+The generated stream is deterministic for a given wordlist, ESSID, rule set and
+budget, so a position in it is as good a checkpoint as a position in the
+wordlist. Words the wordlist already has, or that an earlier rule produced, are
+suppressed through a Bloom filter instead of a set of every string.
+"""
+import hashlib
+import math
+import os
+import struct
+import time
+
+from wpatools.mask import VENDOR_VERSION, masks_for
+
+# a small set in the spirit of hashcat's best64, plus the years people append
+DEFAULT_RULES = [
+    'c', 'u', 'l', 'r', 'd', 't', 'C',
+    '$1', '$!', '$1 $2', '$1 $2 $3', '$1 $2 $3 $4', '$0 $1', '$1 $!', '^1',
+    'c $1', 'c $!', 'c $1 $2 $3', 'c $1 $!',
+    'sa@', 'se3', 'so0', 'si1', 'ss$', 'c so0', 'c sa@', 'sa@ se3 so0 si1',
+    ']', '[', 'f', 'c d',
+] + [f'$2 $0 ${year // 10 % 10} ${year % 10}' for year in range(time.localtime().tm_year, 1989, -1)] \
+  + [f'c $2 $0 ${year // 10 % 10} ${year % 10}' for year in range(time.localtime().tm_year, 2009, -1)]
+
+
+def _toggle(c):
+    return c.swapcase() if c.isalpha() else c
+
+
+def _index(c):
+    # hashcat positions: 0-9 then A-Z for 10-35
+    return int(c, 36)
+
+
+def parse_rule(line):
+    """Turn a hashcat rule line into a function on str, or None for rules this engine doesn't know."""
+    line = line.strip()
+    if not line or line.startswith('#'):
+        return None
+    ops = []
+    i = 0
+    while i < len(line):
+        op = line[i]
+        i += 1
+        if op == ' ':
+            continue
+        simple = {
+            ':': lambda w: w,
+            'l': str.lower,
+            'u': str.upper,
+            'c': lambda w: w[:1].upper() + w[1:].lower(),
+            'C': lambda w: w[:1].lower() + w[1:].upper(),
+            't': str.swapcase,
+            'r': lambda w: w[::-1],
+            'd': lambda w: w + w,
+            'f': lambda w: w + w[::-1],
+            '[': lambda w: w[1:],
+            ']': lambda w: w[:-1],
+        }
+        if op in simple:
+            ops.append(simple[op])
+        elif op in '$^@T' and i < len(line):
+            arg = line[i]
+            i += 1
+            if op == '$':
+                ops.append(lambda w, a=arg: w + a)
+            elif op == '^':
+                ops.append(lambda w, a=arg: a + w)
+            elif op == '@':
+                ops.append(lambda w, a=arg: w.replace(a, ''))
+            else:
+                n = _index(arg)
+                ops.append(lambda w, n=n: w[:n] + _toggle(w[n]) + w[n + 1:] if n < len(w) else w)
+        elif op == 's' and i + 1 < len(line):
+            old, new = line[i], line[i + 1]
+            i += 2
+            ops.append(lambda w, o=old, n=new: w.replace(o, n))
+        elif op == 'D' and i < len(line):
+            n = _index(line[i])
+            i += 1
+            ops.append(lambda w, n=n: w[:n] + w[n + 1:])
+        else:
+            return None
+
+    def apply(word):
+        for op in ops:
+            word = op(word)
+        return word
+    return apply
+
+
+def load_rules(path=None):
+    """(fingerprint, [rule functions]) of a hashcat .rule file, or of DEFAULT_RULES without one."""
+    if path:
+        with open(path, encoding='utf-8', errors='replace') as f:
+            lines = f.read().splitlines()
+    else:
+        lines = DEFAULT_RULES
+    rules = [rule for rule in map(parse_rule, lines) if rule]
+    # the ESSID guesses use the current year too
+    return hashlib.sha1('\n'.join([str(time.localtime().tm_year)] + lines).encode()).hexdigest()[:16], rules
+
+
+BLOOM_MAGIC = b'WPAB'
+BLOOM_HEADER = struct.Struct('<4sxxxxQI40s')  # magic, size in bits, hashes, version of what was added
+
+
+class BloomFilter:
+    """Set membership in about 10 bits per item at a 1% false positive rate."""
+
+    def __init__(self, capacity, error=0.01):
+        self.size = max(64, int(-capacity * math.log(error) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / max(capacity, 1) * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item):
+        digest = hashlib.blake2b(item, digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, item):
+        """Add item, return True if it was (probably) there already."""
+        present = True
+        for pos in self._positions(item):
+            byte, bit = pos >> 3, 1 << (pos & 7)
+            if not self.bits[byte] & bit:
+                present = False
+                self.bits[byte] |= bit
+        return present
+
+    def copy(self):
+        other = BloomFilter.__new__(BloomFilter)
+        other.size, other.hashes, other.bits = self.size, self.hashes, bytearray(self.bits)
+        return other
+
+    def __contains__(self, item):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(item))
+
+    def save(self, path, version):
+        """Write the filter to path, tagged with the version of what was added to it."""
+        tmp = f'{path}.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(BLOOM_HEADER.pack(BLOOM_MAGIC, self.size, self.hashes, version.encode()))
+            f.write(self.bits)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path, version, capacity):
+        """The filter save() wrote to path for version and a filter of capacity, or None."""
+        bloom = cls(capacity)
+        try:
+            with open(path, 'rb') as f:
+                magic, size, hashes, saved = BLOOM_HEADER.unpack(f.read(BLOOM_HEADER.size))
+                if (magic, size, hashes, saved.rstrip(b'\0')) != (BLOOM_MAGIC, bloom.size, bloom.hashes, version.encode()):
+                    return None
+                if f.readinto(bloom.bits) != len(bloom.bits):
+                    return None
+        except (OSError, struct.error):
+            return None
+        return bloom
+
+
+def essid_candidates(essid):
+    """Guesses derived from the network name, like 'Smith Family' -> 'smithfamily123'."""
+    name = essid.decode('utf-8', 'replace')
+    bases = dict.fromkeys([name, name.lower(), name.upper(), name.replace(' ', ''), name.replace(' ', '').lower(),
+                           name.replace(' ', '_'), name.replace(' ', '-')])
+    for base in bases:
+        yield base
+        yield base + base
+        for suffix in ('1', '12', '123', '1234', '12345', '123456', '12345678', '!', str(time.localtime().tm_year),
+                       'wifi', 'password'):
+            yield base + suffix
+        yield 'wifi' + base
+
+
+def bssid_candidates(bssid):
+    """Default keys some routers derive from their MAC address."""
+    mac = bssid.hex()
+    for value in (mac, mac[4:], mac[:8], mac[2:], f'{int(mac, 16) - 1:012x}', f'{int(mac, 16) + 1:012x}'):
+        yield value
+        yield value.upper()
+
+
+def extension(words, essid, rules, budget, bloom=None):
+    """Yield up to budget new candidates (bytes, 8 to 63 long): the ESSID guesses, then each rule
+    applied to every word of words() (a callable returning an iterable of bytes), the first rule
+    over the whole list before the second. bloom should already hold the plain words, generated
+    duplicates of them and of each other are left out."""
+    if bloom is None:
+        bloom = BloomFilter(budget)
+
+    def generated():
+        yield from (guess.encode() for guess in essid_candidates(essid))
+        for rule in rules:
+            for word in words():
+                yield rule(word.decode('utf-8', 'replace')).encode()
+
+    left = budget
+    for candidate in generated():
+        if left <= 0:
+            return
+        if 8 <= len(candidate) <= 63 and not bloom.add(candidate):
+            left -= 1
+            yield candidate
+
+
+class Candidates:
+    """A compiled wordlist followed by up to budget candidates the rules make of it, then by the
+    keyspaces of the masks for the ESSID (see wpatools.mask), under one version, so a job
+    position covers all three and resumes in any of them."""
+
+    def __init__(self, wordlist, rules=None, budget=0, masks=(), custom=(), vendor=False):
+        self.wordlist = wordlist
+        self.budget = budget if rules else 0
+        fingerprint, self.rules = rules or ('', [])
+        self.masks = list(masks)
+        self.custom = list(custom)
+        self.vendor = vendor
+        self.version = f'{wordlist.version}:{fingerprint}:{self.budget}' if self.budget else wordlist.version
+        if self.masks or vendor:
+            fingerprint = hashlib.sha1(repr((self.masks, self.custom)).encode()).hexdigest()[:16]
+            self.version += f':{fingerprint}:{VENDOR_VERSION if vendor else ""}'
+        self.bloom = None
+        if self.budget:
+            # filled with every word of the wordlist, which takes minutes on a Pi, so it is kept next to it
+            path = f'{wordlist.path}.bloom'
+            self.bloom = BloomFilter.load(path, wordlist.version, len(wordlist) + self.budget)
+            if self.bloom is None:
+                self.bloom = BloomFilter(len(wordlist) + self.budget)
+                for word in wordlist.words():
+                    self.bloom.add(bytes(word))
+                try:
+                    self.bloom.save(path, wordlist.version)
+                except OSError:
+                    pass
+
+    def __len__(self):
+        return len(self.wordlist) + self.budget
+
+    def total(self, essid):
+        """An upper bound of the number of candidates for essid."""
+        return len(self) + sum(mask.count for mask in self.masks_for(essid))
+
+    def masks_for(self, essid):
+        return masks_for(essid, self.masks, self.custom, self.vendor)
+
+    def stream(self, essid, position=0):
+        """The candidates for essid from position on."""
+        count = len(self.wordlist)
+        if position < count:
+            yield from self.wordlist.words(position)
+        skip = max(0, position - count)
+        if self.budget:
+            # the number of generated candidates is only known by generating them, a position
+            # past them is resumed by running through them again
+            for candidate in extension(self.wordlist.words, essid, self.rules, self.budget, self.bloom.copy()):
+                if skip:
+                    skip -= 1
+                else:
+                    yield candidate
+        for mask in self.masks_for(essid):
+            if skip < mask.count:
+                yield from mask.words(skip)
+            skip = max(0, skip - mask.count)
@@ -0,0 +1,178 @@
+"""
+Wordlists compiled into one deduplicated file that is read through mmap.
+
+All .txt lists of a folder are merged, lines that can't be a WPA passphrase (shorter
+than 8 or longer than 63 bytes) dropped and duplicates removed, optionally ordered by
+how many lists contain a word. The result is a header, an offset index and the words
+back to back, so candidate n is a slice between two offsets: no line splitting or
+length checks while cracking, and resuming at candidate n is a seek. The file
+remembers the sources it was compiled from and is only rebuilt when they change.
+"""
+import glob
+import hashlib
+import heapq
+import mmap
+import os
+import shutil
+import struct
+import sys
+import tempfile
+from array import array
+
+MAGIC = b'WPAW'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<4sHxxI40s')  # magic, format version, word count, sources version
+
+
+def sources_version(folder, order='source'):
+    """Changes whenever a wordlist in folder is added, removed or modified."""
+    digest = hashlib.sha1(f'{FORMAT_VERSION}:{order}:{sys.byteorder}\n'.encode())
+    for path in sorted(glob.glob(os.path.join(folder, '*.txt'))):
+        st = os.stat(path)
+        digest.update(f'{os.path.basename(path)}:{st.st_size}:{st.st_mtime}\n'.encode())
+    return digest.hexdigest()
+
+
+CHUNK = 1 << 18  # words sorted in memory at a time while compiling
+RECORD = struct.Struct('<H')
+
+
+def _write_run(records, folder, runs):
+    records.sort()
+    path = os.path.join(folder, f'run{len(runs)}')
+    with open(path, 'wb') as f:
+        for record in records:
+            f.write(RECORD.pack(len(record)))
+            f.write(record)
+    runs.append(path)
+    records.clear()
+
+
+def _read_run(path):
+    with open(path, 'rb') as f:
+        while True:
+            size = f.read(RECORD.size)
+            if not size:
+                return
+            yield f.read(RECORD.unpack(size)[0])
+
+
+def _external_sort(records, folder):
+    """Yield the bytes records in order, holding at most CHUNK of them in memory at a time."""
+    folder = tempfile.mkdtemp(dir=folder)
+    runs = []
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) == CHUNK:
+            _write_run(chunk, folder, runs)
+    if not runs:
+        yield from sorted(chunk)
+        return
+    if chunk:
+        _write_run(chunk, folder, runs)
+    yield from heapq.merge(*map(_read_run, runs))
+    for run in runs:
+        os.remove(run)
+
+
+def compile_wordlists(folder, path, order='source'):
+    """Merge the .txt wordlists of folder into path. order is 'source' (first occurrence
+    wins) or 'frequency' (words found in the most lists first). Returns the word count.
+
+    Duplicates are removed with two external sorts in a scratch folder next to path, so
+    memory stays bounded however large the lists are: the first groups the occurrences
+    of each word, the second puts the unique words back in the requested order."""
+    version = sources_version(folder, order)
+    scratch = tempfile.mkdtemp(prefix='.wordlist-', dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        def occurrences():
+            # word, newline (which no word contains), global line number and source, so
+            # the occurrences of a word sort next to each other, the first one first
+            seq = 0
+            for source, name in enumerate(sorted(glob.glob(os.path.join(folder, '*.txt')))):
+                with open(name, 'rb') as f:
+                    for line in f:
+                        word = line.rstrip(b'\r\n')
+                        if 8 <= len(word) <= 63:
+                            yield word + b'\n' + struct.pack('>QH', seq, source)
+                            seq += 1
+
+        def unique():
+            word = first = None
+            sources = set()
+            for record in _external_sort(occurrences(), scratch):
+                current, tail = record[:-11], record[-10:]
+                seq, source = struct.unpack('>QH', tail)
+                if current != word:
+                    if word is not None:
+                        yield ordered(word, first, sources)
+                    word, first, sources = current, seq, set()
+                sources.add(source)
+            if word is not None:
+                yield ordered(word, first, sources)
+
+        def ordered(word, first, sources):
+            key = struct.pack('>Q', first)
+            if order == 'frequency':
+                key = struct.pack('>H', 0xffff - min(len(sources), 0xffff)) + key
+            return key + word
+
+        skip = 10 if order == 'frequency' else 8
+        count = 0
+        offsets = array('I', [0])
+        with open(os.path.join(scratch, 'offsets'), 'wb') as index, open(os.path.join(scratch, 'words'), 'wb') as words:
+            for record in _external_sort(unique(), scratch):
+                word = record[skip:]
+                words.write(word)
+                offsets.append(offsets[-1] + len(word))
+                count += 1
+                if len(offsets) > CHUNK:
+                    offsets[:-1].tofile(index)
+                    del offsets[:-1]
+            offsets.tofile(index)
+        tmp = f'{path}.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, FORMAT_VERSION, count, version.encode()))
+            for part in ('offsets', 'words'):
+                with open(os.path.join(scratch, part), 'rb') as src:
+                    shutil.copyfileobj(src, f)
+        os.replace(tmp, path)
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+    return count
+
+
+class Wordlist:
+    """A compiled wordlist, words(start) yields the candidates from the start-th on."""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, fmt, self.count, version = HEADER.unpack_from(self._map)
+        if magic != MAGIC or fmt != FORMAT_VERSION:
+            raise ValueError(f'{path} is not a compiled wordlist')
+        self.path = path
+        self.version = version.decode()
+        self._offsets = memoryview(self._map)[HEADER.size:HEADER.size + 4 * (self.count + 1)].cast('I')
+        self._words = HEADER.size + 4 * (self.count + 1)
+
+    def __len__(self):
+        return self.count
+
+    def words(self, start=0, end=None):
+        offsets, base, buf = self._offsets, self._words, self._map
+        for i in range(start, self.count if end is None else min(end, self.count)):
+            yield buf[base + offsets[i]:base + offsets[i + 1]]
+
+
+def load(folder, path, order='source'):
+    """Return the compiled wordlist of folder, compiling it first if the sources changed."""
+    try:
+        wordlist = Wordlist(path)
+        if wordlist.version == sources_version(folder, order):
+            return wordlist
+    except (OSError, ValueError, struct.error):
+        pass
+    compile_wordlists(folder, path, order)
+    return Wordlist(path)